@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Time freebora's crawl and download functions against a local mock shop.
+
+Example:
+
+    python3 benchmark.py --books 100 --latency 0.05 --bandwidth 1000000
+"""
+
+import time
+import shutil
+import argparse
+import tempfile
+
+from freebora import freebora
+from freebora.mockshop import MockShop
+
+
+def bench(shop, name, func):
+    "Run func, returning a result row with items and bytes per second."
+
+    sent = shop.bytes_sent
+    t0 = time.time()
+    items = func()
+    secs = time.time() - t0
+    mbytes = (shop.bytes_sent - sent) / 1e6
+    return name, items, secs, items / secs, mbytes / secs
+
+
+def main():
+    desc = 'Benchmark freebora against a local stand-in of the O\'Reilly shop.'
+    p = argparse.ArgumentParser(description=desc)
+    p.add_argument('--books', metavar='N', type=int, default=60,
+        help='Number of books in the shop (default: 60).')
+    p.add_argument('--pdf-size', metavar='BYTES', type=int,
+        default=1024 * 1024, help='Size of each PDF (default: 1048576).')
+    p.add_argument('--latency', metavar='SECONDS', type=float, default=0.02,
+        help='Delay before each response (default: 0.02).')
+    p.add_argument('--bandwidth', metavar='BYTES', type=int,
+        help='Bytes per second sent per response (default: unlimited).')
+    p.add_argument('--cat', metavar='NAME', default='data',
+        help='Category to crawl and download (default: data).')
+    p.add_argument('--concurrency', metavar='N', type=int,
+        default=freebora.CONCURRENCY,
+        help='Concurrency of the async functions (default: {0:d}).'.format(
+             freebora.CONCURRENCY))
+    args = p.parse_args()
+
+    shop = MockShop(books=args.books, pdf_size=args.pdf_size,
+        latency=args.latency, bandwidth=args.bandwidth)
+    with shop:
+        freebora.SHOP_URL = freebora.PDF_URL = shop.url
+        urls = shop.pdf_urls(args.cat)
+        rows = []
+
+        def download(f, **kwargs):
+            dest = tempfile.mkdtemp()
+            try:
+                f(urls, dest=dest, **kwargs)
+            finally:
+                shutil.rmtree(dest)
+            return len(urls)
+
+        rows.append(bench(shop, 'get_cats_sync',
+            lambda: len(list(freebora.get_cats_sync()))))
+        rows.append(bench(shop, 'get_cats_async',
+            lambda: len(list(freebora.get_cats_async(
+                concurrency=args.concurrency)))))
+        rows.append(bench(shop, 'download_filelist_sync',
+            lambda: len(list(freebora.download_filelist_sync(args.cat)))))
+        rows.append(bench(shop, 'download_filelist_async',
+            lambda: len(list(freebora.download_filelist_async(args.cat,
+                concurrency=args.concurrency)))))
+        rows.append(bench(shop, 'download_files_sync',
+            lambda: download(freebora.download_files_sync)))
+        rows.append(bench(shop, 'download_files_async',
+            lambda: download(freebora.download_files_async,
+                concurrency=args.concurrency)))
+
+    print('{0:<28s}{1:>8s}{2:>10s}{3:>10s}{4:>10s}'.format(
+        'function', 'files', 'seconds', 'files/s', 'MB/s'))
+    for row in rows:
+        print('{0:<28s}{1:>8d}{2:>10.2f}{3:>10.1f}{4:>10.2f}'.format(*row))
+
+
+if __name__ == '__main__':
+    main()
@@ -9,15 +9,43 @@ from __future__ import unicode_literals, print_function
 import os
 import sys
 import argparse
+import collections
 
 from freebora.version import __version__
+from freebora.retry import RetryPolicy, RETRY_STATUSES
+from freebora.cache import PageCache, CACHE_SIZE
+from freebora.state import CrawlState, TTL
+from freebora.limits import RateLimits, MAX_CONCURRENCY
+from freebora.manifest import Manifest
+from freebora.store import Store
 if sys.version_info.major >= 3:
     from freebora.freebora import download_filelist_sync, \
-        download_files_sync, download_files_async, get_cats_sync
+        download_filelist_async, download_files_sync, download_files_async, \
+        download_files_threaded, download_cat_async, get_cats_sync, \
+        get_cats_async, match_cats, in_shard, make_session, CHUNK_SIZE, \
+        CONCURRENCY, EXECUTOR_SIZE, LIMIT_PER_HOST, PARSE_PROCESSES, \
+        SEGMENTS, SEGMENT_THRESHOLD, TIMEOUT, CONNECT_TIMEOUT, READ_TIMEOUT
 else:
     # Python 2 not really supported, yet
-    from freebora import download_filelist_sync, download_files_sync, \
-        download_files_async, get_cats_sync
+    from freebora import download_filelist_sync, download_filelist_async, \
+        download_files_sync, download_files_async, download_files_threaded, \
+        download_cat_async, get_cats_sync, get_cats_async, match_cats, \
+        in_shard, make_session, CHUNK_SIZE, CONCURRENCY, EXECUTOR_SIZE, \
+        LIMIT_PER_HOST, PARSE_PROCESSES, SEGMENTS, SEGMENT_THRESHOLD, \
+        TIMEOUT, CONNECT_TIMEOUT, READ_TIMEOUT
+
+
+def parse_shard(value):
+    "Return a shard given as I/N, as a tuple of two integers."
+
+    try:
+        i, n = [int(v) for v in value.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError('not like I/N: {0!s}'.format(value))
+    if not 0 <= i < n:
+        raise argparse.ArgumentTypeError(
+            'shard out of range 0 to N-1: {0!s}'.format(value))
+    return i, n
 
 
 def main():
@@ -35,20 +63,146 @@ def main():
     p.add_argument('--overwrite', action='store_true',
         help='Overwrite previously created file(s), for both the URL '
              'list and/or downloaded PDFs.')
-    p.add_argument('--cat', metavar='NAME', default='data',
+    p.add_argument('--cat', metavar='NAME', action='append',
         help='Category of ebooks to download, e.g. data (default), '\
              'design, iot, python/programming, ... Get a full list '\
-             'with --list-cats-sync.')
+             'with --list-cats-sync. Can be given several times, and be '\
+             'a glob pattern like data/*.')
+    p.add_argument('--all-cats', action='store_true',
+        help='Download ebooks of all categories found by --list-cats-sync.')
     p.add_argument('--list-cats-sync', action='store_true',
         help='Collect and list available ebook category names (to use with --cat).')
+    p.add_argument('--list-cats-async', action='store_true',
+        help='Like --list-cats-sync, but fetch category pages in parallel.')
     p.add_argument('--list-sync', metavar='NAME',
         help='Collect URLs to be downloaded into given filename.')
+    p.add_argument('--list-async', metavar='NAME',
+        help='Like --list-sync, but fetch shop pages in parallel.')
     p.add_argument('--fetch-sync', metavar='NAME',
         help='Download URLs sequentially from given filename.')
     p.add_argument('--fetch-async', metavar='NAME',
         help='Download URLs in parallel from given filename.')
+    p.add_argument('--fetch-threaded', metavar='NAME',
+        help='Like --fetch-async, but download in --concurrency threads, '
+             'without aiohttp.')
+    p.add_argument('--sync-all', action='store_true',
+        help='Crawl the categories given by --cat and download their PDFs in '
+             'parallel, starting downloads while the crawl is running.')
+    p.add_argument('--concurrency', metavar='N', type=int,
+        default=CONCURRENCY,
+        help='Maximum number of parallel requests used by the async '
+             'functions, and number of threads used by --fetch-threaded '
+             '(default: {0:d}).'.format(CONCURRENCY))
+    p.add_argument('--adaptive', action='store_true',
+        help='Adapt the number of parallel requests per host to its '
+             'latency and errors, starting at --concurrency.')
+    p.add_argument('--max-concurrency', metavar='N', type=int,
+        default=MAX_CONCURRENCY,
+        help='Maximum number of parallel requests per host with '
+             '--adaptive (default: {0:d}).'.format(MAX_CONCURRENCY))
+    p.add_argument('--max-rps', metavar='N', type=float,
+        help='Maximum number of requests per second to each host '
+             '(default: unlimited).')
+    p.add_argument('--max-bandwidth', metavar='BYTES', type=float,
+        help='Maximum number of bytes per second received from each host '
+             '(default: unlimited).')
+    p.add_argument('--limit-per-host', metavar='N', type=int,
+        default=LIMIT_PER_HOST,
+        help='Maximum number of connections per host used by the async '
+             'functions, 0 for no limit (default: {0:d}).'.format(
+             LIMIT_PER_HOST))
+    p.add_argument('--executor-size', metavar='N', type=int,
+        default=EXECUTOR_SIZE,
+        help='Number of threads writing files for the async downloads, '
+             'and parsing crawled pages if not in processes (default: '
+             '{0:d}).'.format(EXECUTOR_SIZE))
+    p.add_argument('--parse-processes', metavar='N', type=int,
+        default=PARSE_PROCESSES,
+        help='Number of processes parsing crawled pages for the async '
+             'functions, 0 to parse them in threads (default: {0:d}).'.format(
+             PARSE_PROCESSES))
+    p.add_argument('--timeout', metavar='SECONDS', type=float,
+        default=TIMEOUT,
+        help='Total timeout per request, 0 for none (default: {0!s}).'.format(
+             TIMEOUT))
+    p.add_argument('--connect-timeout', metavar='SECONDS', type=float,
+        default=CONNECT_TIMEOUT,
+        help='Timeout for connecting to a host, 0 for none '
+             '(default: {0!s}).'.format(CONNECT_TIMEOUT))
+    p.add_argument('--read-timeout', metavar='SECONDS', type=float,
+        default=READ_TIMEOUT,
+        help='Timeout between two reads from a connection, 0 for none '
+             '(default: {0!s}).'.format(READ_TIMEOUT))
+    p.add_argument('--segments', metavar='N', type=int, default=SEGMENTS,
+        help='Number of parallel range requests to download large PDFs '
+             'with in the async functions (default: {0:d}).'.format(SEGMENTS))
+    p.add_argument('--segment-threshold', metavar='MB', type=float,
+        default=SEGMENT_THRESHOLD / 1024 / 1024,
+        help='Minimum size of PDFs to download in segments '
+             '(default: {0:g}).'.format(SEGMENT_THRESHOLD / 1024 / 1024))
+    p.add_argument('--chunk-size', metavar='BYTES', type=int,
+        default=CHUNK_SIZE,
+        help='Size of the chunks in which downloaded PDFs are written to '
+             'disk (default: {0:d}).'.format(CHUNK_SIZE))
+    p.add_argument('--pool-size', metavar='N', type=int, default=10,
+        help='Number of keep-alive connections per host used by the '
+             'sync functions, or per thread by --fetch-threaded '
+             '(default: 10).')
+    p.add_argument('--cache', metavar='PATH',
+        help='Cache crawled shop pages in given file, and revalidate them '
+             'with the shop on later runs.')
+    p.add_argument('--cache-size', metavar='MB', type=float,
+        default=CACHE_SIZE / 1024 / 1024,
+        help='Maximum size of the pages in the cache, dropping the least '
+             'recently used ones beyond (default: {0:g}).'.format(
+             CACHE_SIZE / 1024 / 1024))
+    p.add_argument('--incremental', action='store_true',
+        help='Only fetch product pages not resolved to PDF URLs by '
+             'earlier crawls, as recorded in the crawl state file.')
+    p.add_argument('--state', metavar='PATH',
+        help='Crawl state file used by --incremental (default: '
+             '.freebora-state.db in the destination folder).')
+    p.add_argument('--ttl', metavar='DAYS', type=float,
+        default=TTL / 24 / 3600,
+        help='Fetch product pages again if resolved longer ago than this, '
+             '0 for never (default: {0:g}).'.format(TTL / 24 / 3600))
+    p.add_argument('--manifest', metavar='PATH',
+        help='Record of completed downloads, deciding what is left to '
+             'download (default: .freebora-manifest.db in the destination '
+             'folder).')
+    p.add_argument('--refresh', action='store_true',
+        help='Request PDFs recorded in the manifest again, conditionally, '
+             'fetching only those changed since their last download, or '
+             'with their file gone.')
+    p.add_argument('--store', metavar='PATH',
+        help='Folder storing downloaded PDFs once by content, linked into '
+             'destination folders, and skipping URLs downloaded into any of '
+             'these before.')
+    p.add_argument('--shard', metavar='I/N', type=parse_shard,
+        help='Only crawl the products, or fetch the URLs, of shard I of N, '
+             'counting from 0, as assigned by a stable hash, to split work '
+             'over N processes or machines. Shard either the crawl or the '
+             'fetch of a shared URL list, not both, so --list-* and '
+             '--fetch-* cannot be sharded in one run. Shards may share '
+             '--dest, --store and the manifest, but not across machines, '
+             'as SQLite files need local file locks.')
+    p.add_argument('--max-attempts', metavar='N', type=int, default=5,
+        help='Maximum number of attempts per URL before giving up on it '
+             '(default: 5).')
+    p.add_argument('--backoff', metavar='SECONDS', type=float, default=0.5,
+        help='Base delay of the exponential backoff between attempts '
+             '(default: 0.5).')
+    p.add_argument('--retry-on', metavar='CODES',
+        default=','.join(map(str, RETRY_STATUSES)),
+        help='Comma-separated HTTP status codes to retry requests for '
+             '(default: {0!s}).'.format(','.join(map(str, RETRY_STATUSES))))
 
     args = p.parse_args()
+    # Crawls are sharded by product, fetches by URL, so sharding both would
+    # drop the URLs crawled by one shard but fetched by another.
+    if args.shard and (args.list_sync or args.list_async) and \
+            (args.fetch_sync or args.fetch_async or args.fetch_threaded):
+        p.error('--shard cannot split both --list-* and --fetch-* in one run')
 
     if args.version:
         print('Freebora version {0!s}'.format(__version__))
@@ -63,33 +217,135 @@ def main():
         if args.verbose and os.path.exists(args.dest) and created:
             print('Created destination folder: "{0!s}"'.format(args.dest))
 
+    # All sync functions share one pool of keep-alive connections.
+    session = make_session(pool_size=args.pool_size)
+    retry = RetryPolicy(max_attempts=args.max_attempts, backoff=args.backoff,
+        retry_statuses=[int(c) for c in args.retry_on.split(',') if c])
+    failed = []
+
+    # Keyword arguments shared by all sync and async functions, resp.
+    net = dict(retry=retry, timeout=args.timeout or None,
+        connect_timeout=args.connect_timeout or None,
+        read_timeout=args.read_timeout or None,
+        rates=RateLimits(args.max_rps, args.max_bandwidth))
+    sync_kwargs = dict(net, session=session)
+    async_kwargs = dict(net, concurrency=args.concurrency,
+        limit_per_host=args.limit_per_host, adaptive=args.adaptive,
+        max_concurrency=args.max_concurrency, executor_size=args.executor_size)
+    crawl_kwargs = dict(async_kwargs, parse_processes=args.parse_processes)
+    segment_kwargs = dict(segments=args.segments,
+        segment_threshold=int(args.segment_threshold * 1024 * 1024))
+
+    # Crawled pages can be cached between runs.
+    cache = None
+    if args.cache:
+        cache = PageCache(args.cache,
+            max_size=int(args.cache_size * 1024 * 1024))
+
+    # Product pages resolved before can be skipped.
+    state = None
+    if args.incremental:
+        state = CrawlState(
+            args.state or os.path.join(args.dest, '.freebora-state.db'),
+            ttl=args.ttl * 24 * 3600)
+
+    # Completed downloads are recorded, and never fetched again, unless
+    # refreshed if changed.
+    manifest = None
+    if args.fetch_sync or args.fetch_async or args.fetch_threaded or \
+            args.sync_all:
+        manifest = Manifest(
+            args.manifest or os.path.join(args.dest, '.freebora-manifest.db'))
+
+    # Downloads can be shared by destination folders.
+    store = None
+    if args.store:
+        store = Store(args.store)
+
     # Get list of free ebook categories.
     if args.list_cats_sync:
-        for cat in get_cats_sync(full_urls=False, verbose=args.verbose):
+        for cat in get_cats_sync(full_urls=False, verbose=args.verbose,
+                failed=failed, cache=cache, **sync_kwargs):
             print(cat)
+    if args.list_cats_async:
+        for cat in get_cats_async(full_urls=False, verbose=args.verbose,
+                failed=failed, cache=cache, **crawl_kwargs):
+            print(cat)
+
+    # Expand category patterns, with each product crawled only once.
+    cats = args.cat or ['data']
+    crawling = args.list_sync or args.list_async or args.sync_all
+    if crawling and (args.all_cats or any(set('*?[') & set(c) for c in cats)):
+        found = list(get_cats_sync(full_urls=False, verbose=args.verbose,
+            failed=failed, cache=cache, **sync_kwargs))
+        cats = match_cats(['*'] if args.all_cats else cats, found)
 
     # Get list of URLs for free ebooks.
-    if args.list_sync:
-        path = os.path.join(args.dest, args.list_sync)
+    if args.list_sync or args.list_async:
+        if args.list_sync:
+            path = os.path.join(args.dest, args.list_sync)
+            kwargs = sync_kwargs
+            lister = download_filelist_sync
+        elif args.list_async:
+            path = os.path.join(args.dest, args.list_async)
+            kwargs = crawl_kwargs
+            lister = download_filelist_async
         if not os.path.exists(path) or args.overwrite:
-            for url in  download_filelist_sync(cat=args.cat, verbose=args.verbose):
+            for url in lister(cat=cats, verbose=args.verbose,
+                    failed=failed, cache=cache, state=state,
+                    shard=args.shard, **kwargs):
                 with open(path, 'a') as f:
                     f.write('{0!s}\n'.format(url))
 
     # Fetch PDFs for given URLs.
-    if args.fetch_sync or args.fetch_async:
+    if args.fetch_sync or args.fetch_async or args.fetch_threaded:
         if args.fetch_sync:
             path = args.fetch_sync
         elif args.fetch_async:
             path = args.fetch_async
+        elif args.fetch_threaded:
+            path = args.fetch_threaded
         urls = open(os.path.join(args.dest, path)).read().strip().split('\n')
+        urls = list(collections.OrderedDict.fromkeys(urls))
         print('#URLs found: {0:d}'.format(len(urls)))
+        if args.shard:
+            urls = [url for url in urls if in_shard(url, *args.shard)]
+            print('#URLs in shard: {0:d}'.format(len(urls)))
 
         if args.fetch_sync:
             f = download_files_sync
+            kwargs = sync_kwargs
         elif args.fetch_async:
             f = download_files_async
-        f(urls, dest=args.dest, overwrite=args.overwrite, verbose=args.verbose)
+            kwargs = dict(async_kwargs, **segment_kwargs)
+        elif args.fetch_threaded:
+            f = download_files_threaded
+            kwargs = dict(net, workers=args.concurrency,
+                pool_size=args.pool_size)
+        failed += f(urls, dest=args.dest, overwrite=args.overwrite,
+            verbose=args.verbose, chunk_size=args.chunk_size,
+            manifest=manifest, store=store, refresh=args.refresh, **kwargs)
+
+    # Crawl and fetch PDFs in one pipelined run.
+    if args.sync_all:
+        failed += download_cat_async(cats, dest=args.dest,
+            overwrite=args.overwrite, verbose=args.verbose,
+            chunk_size=args.chunk_size, failed=failed, cache=cache,
+            state=state, manifest=manifest, store=store, refresh=args.refresh,
+            shard=args.shard, **dict(crawl_kwargs, **segment_kwargs))
+
+    if state is not None:
+        state.close()
+    if manifest is not None:
+        manifest.close()
+    if store is not None:
+        store.close()
+
+    # Report URLs given up on after all retries.
+    if failed:
+        print('#URLs failed: {0:d}'.format(len(failed)), file=sys.stderr)
+        for url in failed:
+            print(url, file=sys.stderr)
 
 
 if __name__ == '__main__':
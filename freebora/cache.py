@@ -0,0 +1,106 @@
+"""
+A persistent cache of crawled shop pages, revalidated with the server.
+
+Pages are stored in an SQLite file with their ``ETag`` and ``Last-Modified``
+headers, plus whatever was extracted from them, so a page the server
+confirms to be unchanged (304) needs neither to be transferred nor to be
+parsed again. The least recently used pages are evicted when the bodies
+stored exceed a maximum size.
+"""
+
+import json
+import time
+import sqlite3
+import threading
+import collections
+
+
+CACHE_SIZE = 50 * 1024 * 1024
+
+CachedPage = collections.namedtuple('CachedPage',
+    'etag last_modified body extracted')
+
+
+class PageCache(object):
+    "An on-disk LRU cache of pages with their validators and extracts."
+
+    def __init__(self, path, max_size=CACHE_SIZE):
+        self.path = path
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS pages ('
+            'url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, '
+            'body BLOB, extracted TEXT, size INTEGER, atime REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS pages_atime '
+            'ON pages (atime)')
+        self._db.commit()
+        self.size = self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM pages').fetchone()[0]
+
+    def get(self, url):
+        "Return the cached page for some URL, or None."
+
+        with self._lock:
+            row = self._db.execute('SELECT etag, last_modified, body, '
+                'extracted FROM pages WHERE url = ?', (url,)).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, body, extracted = row
+        return CachedPage(etag, last_modified, body, json.loads(extracted))
+
+    def headers(self, page):
+        "Return the request headers revalidating some cached page."
+
+        headers = {}
+        if page is not None:
+            if page.etag:
+                headers['If-None-Match'] = page.etag
+            if page.last_modified:
+                headers['If-Modified-Since'] = page.last_modified
+        return headers
+
+    def put(self, url, etag, last_modified, body, extracted):
+        "Store a page with its validators and a dict of what was extracted."
+
+        if not etag and not last_modified:
+            return
+        size = len(body)
+        with self._lock:
+            row = self._db.execute('SELECT size FROM pages WHERE url = ?',
+                (url,)).fetchone()
+            self.size += size - (row[0] if row else 0)
+            self._db.execute('INSERT OR REPLACE INTO pages VALUES '
+                '(?, ?, ?, ?, ?, ?, ?)', (url, etag, last_modified, body,
+                json.dumps(extracted), size, time.time()))
+            self._evict()
+            self._db.commit()
+
+    def touch(self, url, extracted=None):
+        "Mark a page as recently used, optionally updating its extracts."
+
+        with self._lock:
+            if extracted is None:
+                self._db.execute('UPDATE pages SET atime = ? WHERE url = ?',
+                    (time.time(), url))
+            else:
+                self._db.execute('UPDATE pages SET atime = ?, extracted = ? '
+                    'WHERE url = ?', (time.time(), json.dumps(extracted), url))
+            self._db.commit()
+
+    def _evict(self):
+        "Delete least recently used pages until the cache fits its size."
+
+        rows = self._db.execute('SELECT url, size FROM pages '
+            'ORDER BY atime')
+        evicted = []
+        for url, size in rows:
+            if self.size <= self.max_size:
+                break
+            evicted.append((url,))
+            self.size -= size
+        self._db.executemany('DELETE FROM pages WHERE url = ?', evicted)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -1,145 +1,1493 @@
 
 import re
 import os
+import fnmatch
+import hashlib
+import time
 import asyncio
-import concurrent
+import threading
+import contextlib
+import collections
+import concurrent.futures
 
 import requests
 import aiohttp
 import aiofiles
 from lxml import etree
 
+from freebora.retry import RetryPolicy, TransientError
+from freebora.limits import FixedLimit, HostLimits, RateLimits, \
+    MAX_CONCURRENCY
+from freebora.manifest import Entry
+
+
+# Where to crawl and download from, see freebora.mockshop for a stand-in.
+SHOP_URL = 'http://shop.oreilly.com'
+PDF_URL = 'http://www.oreilly.com'
+CHUNK_SIZE = 64 * 1024
+PAGE_CHUNK_SIZE = 8 * 1024
+
+# Default network knobs, all overridable per call. Timeouts are seconds,
+# None meaning no timeout, and a limit per host of 0 means no limit.
+CONCURRENCY = 10
+EXECUTOR_SIZE = 20
+PARSE_PROCESSES = 0
+SEGMENTS = 1
+SEGMENT_THRESHOLD = 8 * 1024 * 1024
+# PDF readers look for the end-of-file marker within this many last bytes.
+PDF_TAIL_SIZE = 1024
+# Temporary files not written for this long are left by no running process.
+STALE_AGE = 3600
+LIMIT_PER_HOST = 0
+TIMEOUT = 60
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+CAT_XPATH = '//a[starts-with(@href, "/category/ebooks/")]/@href'
+PAGE_XPATH = '//td[@class="default"]/select[@name="dirPage"]/option/@value'
+PRODUCT_XPATH = '//span[@class="price"][contains(., "$0.00")]/'\
+                '../../../../div[@class="thumbheader"]/a/@href'
+
+# Compiled once at import time and shared by all calls, returning plain
+# strings, not ones keeping the whole tree of their page alive.
+_cat_xpath = etree.XPath(CAT_XPATH, smart_strings=False)
+_page_xpath = etree.XPath(PAGE_XPATH, smart_strings=False)
+_product_xpath = etree.XPath(PRODUCT_XPATH, smart_strings=False)
+_path_info_re = re.compile(br'path_info:\s+(.*?\.csp)')
+_cat_name_re = re.compile(r'category/ebooks/(.*?).do')
+_content_range_re = re.compile(r'bytes (\d+|\*)(?:-\d+)?/(\d+|\*)')
+
+# Errors worth retrying a request for, and errors failing it for good.
+SYNC_ERRORS = (requests.ConnectionError, requests.Timeout,
+    requests.exceptions.ChunkedEncodingError, TransientError)
+ASYNC_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, TransientError)
+FAILURES = (IOError, aiohttp.ClientError, asyncio.TimeoutError)
+
+
+# helpers
+
+def _cat_paths(html):
+    "Return the category page paths linked from some HTML page."
+
+    if not html:
+        return []
+    tree = etree.fromstring(html, parser=etree.HTMLParser())
+    if tree is None:
+        return []
+    return [u for u in _cat_xpath(tree) if u.endswith('.do')]
+
+
+def _page_paths(html):
+    "Return the unique pagination page paths of some category page."
+
+    if not html:
+        return []
+    tree = etree.fromstring(html, parser=etree.HTMLParser())
+    if tree is None:
+        return []
+    return sorted(set(_page_xpath(tree)))
+
+
+def _product_paths(html):
+    "Return the paths of free products listed on some pagination page."
+
+    if not html:
+        return []
+    tree = etree.fromstring(html, parser=etree.HTMLParser())
+    if tree is None:
+        return []
+    return _product_xpath(tree)
+
+
+def _pdf_url(html):
+    "Return the PDF URL referenced by some product page, or None."
+
+    if not html:
+        return None
+    if not isinstance(html, bytes):
+        html = html.encode('utf-8')
+    m = _path_info_re.search(html)
+    if m is None:
+        return None
+    url_csp = m.group(1).decode('utf-8', 'replace').split('?')[0]
+    url_pdf = url_csp.replace('.csp', '.pdf')
+    url_pdf = url_pdf.replace('/free/', '/free/files/')
+    return '%s/%s' % (PDF_URL, url_pdf)
+
+
+Timeouts = collections.namedtuple('Timeouts', 'total connect read')
+
+
+def _deadline(timeouts):
+    "Return the time by which a request has to be done, or None."
+
+    return time.monotonic() + timeouts.total if timeouts.total else None
+
+
+class _Crawl(object):
+    "What all page requests of one crawl share, be it sync or async."
+
+    def __init__(self, session=None, retry=None, timeouts=None, cache=None,
+        failed=None, verbose=False, concurrency=CONCURRENCY,
+        limit_per_host=LIMIT_PER_HOST, state=None,
+        parse_processes=PARSE_PROCESSES, adaptive=False,
+        max_concurrency=MAX_CONCURRENCY, rates=None, shard=None,
+        queue_size=None):
+        self.session = session
+        self.retry = retry or RetryPolicy()
+        self.timeouts = timeouts or Timeouts(TIMEOUT, CONNECT_TIMEOUT,
+            READ_TIMEOUT)
+        self.cache = cache
+        self.failed = failed
+        self.verbose = verbose
+        self.concurrency = concurrency
+        self.limit_per_host = limit_per_host
+        self.state = state
+        self.adaptive = adaptive
+        self.max_concurrency = max_concurrency
+        self.limits = None
+        self.rates = rates or RateLimits()
+        self.seen = set()
+        self.shard = shard
+        self.queue_size = queue_size
+        self.parse_processes = parse_processes
+        self.parser = None
+
+    def first(self, key):
+        "Return if a product path or PDF URL is seen first in this crawl."
+
+        if key in self.seen:
+            return False
+        self.seen.add(key)
+        return True
+
+    def mine(self, path):
+        "Return if a product path falls into the shard of this crawl, if any."
+
+        return self.shard is None or in_shard(path, *self.shard)
+
+    @property
+    def workers(self):
+        "Return how many requests this crawl may ever have in flight."
+
+        return self.max_concurrency if self.adaptive else self.concurrency
+
+    def client_session(self):
+        "Return a new aiohttp session for this crawl."
+
+        self.limits = _limits(self.concurrency, self.adaptive,
+            self.max_concurrency, self.verbose)
+        return _client_session(self.timeouts, self.limit_per_host)
+
+    def parser_pool(self):
+        """Return a new pool of processes parsing pages for this crawl.
+
+        Without parse processes, pages are parsed in the executor threads
+        of the event loop, lxml releasing the GIL while parsing.
+        """
+        if not self.parse_processes:
+            return contextlib.nullcontext()
+        return concurrent.futures.ProcessPoolExecutor(self.parse_processes)
+
+    async def parse(self, html, extract):
+        "Run extract on some HTML off the event loop, in the parser pool."
+
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.parser, extract, html)
+
+    def _fail(self, url, exc):
+        "Add a URL to the failed ones, if these are collected at all."
+
+        if self.failed is None:
+            raise exc
+        if self.verbose:
+            print('failed %s (%s)' % (url, exc))
+        self.failed.append(url)
+
+    def _cached(self, url):
+        "Return the cached page for some URL and headers revalidating it."
+
+        if self.cache is None:
+            return None, {}
+        page = self.cache.get(url)
+        return page, self.cache.headers(page)
+
+    def _source(self, status, html, page, extract):
+        "Return the HTML to run extract on for some response, or None."
+
+        if status == 304 and page is not None:
+            if extract.__name__ in page.extracted:
+                return None
+            return page.body
+        return html
+
+    def _extract(self, url, status, headers, html, page, extract, result):
+        "Return what extract returned for some response, using the cache."
+
+        name = extract.__name__
+        if status == 304 and page is not None:
+            if name in page.extracted:
+                self.cache.touch(url)
+            else:
+                page.extracted[name] = result
+                self.cache.touch(url, page.extracted)
+            return page.extracted[name]
+        if self.cache is not None and status == 200:
+            self.cache.put(url, headers.get('ETag'),
+                headers.get('Last-Modified'), html, {name: result})
+        return result
+
+    def extract_sync(self, url, extract):
+        """Fetch some page and return what extract returns for its HTML.
+
+        If the page cannot be fetched, its URL is added to the failed list,
+        if one is given, and extract gets None as HTML.
+        """
+        return self._try_extract_sync(url, extract)[1]
+
+    async def extract(self, url, extract):
+        "Like extract_sync, but fetching the page asynchronously."
+
+        return (await self._try_extract(url, extract))[1]
+
+    def resolve_sync(self, path):
+        "Return the PDF URL of some product page, or None."
+
+        if self.state is not None:
+            known, u = self.state.get(path)
+            if known:
+                return u
+        ok, u = self._try_extract_sync(SHOP_URL + path, _pdf_url,
+            until=_path_info_re)
+        if ok and self.state is not None:
+            self.state.put(path, u)
+        return u
+
+    async def resolve(self, path):
+        "Like resolve_sync, but fetching the product page asynchronously."
+
+        if self.state is not None:
+            known, u = self.state.get(path)
+            if known:
+                return u
+        ok, u = await self._try_extract(SHOP_URL + path, _pdf_url,
+            until=_path_info_re)
+        if ok and self.state is not None:
+            self.state.put(path, u)
+        return u
+
+    def _try_extract_sync(self, url, extract, until=None):
+        """Return if some page could be fetched, and what was extracted.
+
+        Given a compiled pattern to read until, the page is read in small
+        chunks and its connection closed as soon as the pattern is found.
+        """
+        page, headers = self._cached(url)
+
+        def get():
+            self.rates.request(url)
+            deadline = _deadline(self.timeouts)
+            with self.session.get(url, headers=headers, stream=True,
+                    timeout=(self.timeouts.connect, self.timeouts.read)) \
+                    as response:
+                self.retry.check(url, response.status_code)
+                if response.status_code >= 400:
+                    raise IOError('HTTP status %d for %s' % (
+                        response.status_code, url))
+                if until is None:
+                    chunks = _iter_content(response, CHUNK_SIZE, deadline,
+                        self.rates)
+                    html = b''.join(chunks)
+                else:
+                    chunks = _iter_content(response, PAGE_CHUNK_SIZE,
+                        deadline, self.rates)
+                    html = _read_until(chunks, until)
+                return response.status_code, response.headers, html
+
+        try:
+            status, headers, html = self.retry.call(get, SYNC_ERRORS,
+                url=url, verbose=self.verbose)
+        except FAILURES as exc:
+            self._fail(url, exc)
+            return False, extract(None)
+        source = self._source(status, html, page, extract)
+        result = None if source is None else extract(source)
+        return True, self._extract(url, status, headers, html, page, extract,
+            result)
+
+    async def _try_extract(self, url, extract, until=None):
+        """Like _try_extract_sync, but fetching the page asynchronously.
+
+        Pages are parsed in the parser pool, unless read only until some
+        pattern, which is then found already.
+        """
+        page, headers = self._cached(url)
+
+        async def get():
+            await self.rates.request_async(url)
+            async with self.limits.slot(url) as slot:
+                async with self.session.get(url, headers=headers) as response:
+                    slot.responded()
+                    self.retry.check(url, response.status)
+                    if response.status >= 400:
+                        raise IOError('HTTP status %d for %s' % (
+                            response.status, url))
+                    html = b''
+                    async for chunk in response.content.iter_chunked(
+                            PAGE_CHUNK_SIZE if until else CHUNK_SIZE):
+                        html += chunk
+                        await self.rates.received_async(url, len(chunk))
+                        if until and until.search(html):
+                            response.close()
+                            break
+                    return response.status, response.headers, html
+
+        try:
+            status, headers, html = await self.retry.call_async(get,
+                ASYNC_ERRORS, url=url, verbose=self.verbose)
+        except FAILURES as exc:
+            self._fail(url, exc)
+            return False, extract(None)
+        source = self._source(status, html, page, extract)
+        if source is None:
+            result = None
+        elif until is None:
+            result = await self.parse(source, extract)
+        else:
+            result = extract(source)
+        return True, self._extract(url, status, headers, html, page, extract,
+            result)
+
+
+def _read_until(chunks, until):
+    "Join chunks of a page until some compiled pattern is found in them."
+
+    html = b''
+    for chunk in chunks:
+        html += chunk
+        if until.search(html):
+            break
+    return html
+
+
+def _cat_name(path):
+    "Return the category name for some category page path."
+
+    return _cat_name_re.findall(path)[0]
+
+
+def _cat_list(cat):
+    "Return a list of categories for a single one or several."
+
+    return [cat] if isinstance(cat, str) else list(cat)
+
+
+def match_cats(patterns, cats):
+    """Return the categories matching some names or glob patterns, in order.
+
+    Plain names are returned as they are, patterns like ``data/*`` are
+    matched against the given categories, e.g. from get_cats_sync.
+    """
+    matched = []
+    for pattern in _cat_list(patterns):
+        if not any(c in pattern for c in '*?['):
+            names = [pattern]
+        else:
+            names = fnmatch.filter(cats, pattern)
+        matched.extend(n for n in names if n not in matched)
+    return matched
+
+
+def in_shard(key, shard, shards):
+    """Return if some URL or path falls into shard number shard (from 0).
+
+    Keys are assigned by rendezvous hashing, to the shard scoring highest
+    for them, so all processes agree on it without coordination, and with
+    one more shard, only the keys it takes over move.
+    """
+    key = key.encode('utf-8')
+    scores = [hashlib.sha1(b'%d:%s' % (i, key)).digest()
+        for i in range(shards)]
+    return scores.index(max(scores)) == shard
+
+
+def _iter_async(agen, executor_size=EXECUTOR_SIZE):
+    "Drive an async generator from sync code, yielding items as they come."
+
+    # The default executor parses pages, unless in a pool of processes.
+    loop = asyncio.new_event_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(executor_size)
+    loop.set_default_executor(executor)
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(agen.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(agen.aclose())
+        executor.shutdown(wait=True)
+        loop.close()
+
+
+def _validator(headers):
+    "Return the ETag or Last-Modified of a response to resume it with, if any."
+
+    # Weak ETags must not be used for range requests (RFC 7233).
+    etag = headers.get('ETag')
+    if etag and not etag.startswith('W/'):
+        return etag
+    return headers.get('Last-Modified')
+
+
+def _remember(part, headers):
+    "Keep the validator of the response written to a partial download."
+
+    validator = _validator(headers)
+    if validator:
+        with open(part + '.validator', 'w') as f:
+            f.write(validator)
+    elif os.path.exists(part + '.validator'):
+        os.remove(part + '.validator')
+
+
+def _discard(part):
+    "Remove a partial download and its validator, if any."
+
+    for path in part, part + '.validator':
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _resume_headers(part):
+    """Return offset and request headers for resuming some partial download.
+
+    A partial download is only resumed with the validator of the response
+    it was written from, so the server sends all of the file again if it
+    changed since. Without one, it is written from scratch.
+    """
+    # Ask for the raw bytes, so offsets and sizes refer to the file on disk.
+    headers = {'Accept-Encoding': 'identity'}
+    offset = os.path.getsize(part) if os.path.exists(part) else 0
+    validator = None
+    if offset and os.path.exists(part + '.validator'):
+        with open(part + '.validator') as f:
+            validator = f.read()
+    if validator:
+        headers['Range'] = 'bytes=%d-' % offset
+        headers['If-Range'] = validator
+    else:
+        offset = 0
+    return offset, headers
+
+
+def _resume_plan(url, part, status, headers, offset):
+    """Return offset and expected total size for writing some response.
+
+    An offset of zero means the partial file has to be written from scratch.
+    A total of None means the server did not tell the size of the file.
+    """
+    m = _content_range_re.match(headers.get('Content-Range', ''))
+    total = int(m.group(2)) if m and m.group(2) != '*' else None
+    if status == 206:
+        if not m or m.group(1) != str(offset):
+            raise IOError('unexpected range %r for %s' % (
+                headers.get('Content-Range'), url))
+        return offset, total
+    if status == 416:
+        # Nothing left to fetch if the partial file is complete already.
+        if total is not None and total == offset:
+            return offset, total
+        _discard(part)
+        raise TransientError('cannot resume %s at byte %d' % (url, offset))
+    if status >= 400:
+        raise IOError('HTTP status %d for %s' % (status, url))
+    length = headers.get('Content-Length')
+    return 0, int(length) if length else None
+
+
+def _commit(tmp, path):
+    """Give a temporary file its final name, durably.
+
+    The file is synced to disk before the atomic rename, and the directory
+    after it, so after a crash the file is either complete or not there.
+    """
+    fd = os.open(tmp, os.O_RDWR)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    os.replace(tmp, path)
+    try:
+        fd = os.open(os.path.dirname(path) or '.', os.O_RDONLY)
+    except OSError:
+        # Directories cannot be opened on some platforms, e.g. Windows.
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+class _Check(object):
+    "SHA-256, size, head and tail of a download, fed as it is written."
+
+    def __init__(self):
+        self.sha = hashlib.sha256()
+        self.size = 0
+        self.head = b''
+        self.tail = b''
+
+    def update(self, chunk):
+        self.sha.update(chunk)
+        self.size += len(chunk)
+        if len(self.head) < 5:
+            self.head += chunk[:5 - len(self.head)]
+        if len(chunk) >= PDF_TAIL_SIZE:
+            self.tail = chunk[-PDF_TAIL_SIZE:]
+        else:
+            self.tail = (self.tail + chunk)[-PDF_TAIL_SIZE:]
+
+    def error(self, path):
+        """Return the error of a file not being a complete PDF, or None.
+
+        A file without PDF header is no PDF at all, and fails for good, but
+        one without trailer is likely cut off, and is retried.
+        """
+        if not self.head.startswith(b'%PDF-'):
+            return IOError('no PDF header in %s' % path)
+        if b'%%EOF' not in self.tail:
+            return TransientError('no PDF trailer in %s' % path)
+        return None
+
+    def verify(self, part, path):
+        "Remove a partial download and raise an error unless it is a PDF."
+
+        error = self.error(path)
+        if error is not None:
+            _discard(part)
+            raise error
+
+
+def _finish_part(part, path, size, total, check=None):
+    """Give a partial download its final name if it has the expected size.
+
+    Given a check of its content, it must be a complete PDF, too.
+    """
+    if total is not None and size != total:
+        raise TransientError('incomplete download of %s (%d of %d bytes)' % (
+            path, size, total))
+    if check is not None:
+        check.verify(part, path)
+    _commit(part, path)
+    _discard(part)
+
+
+def _digest(path, size):
+    "Return a check fed with the first bytes of some file."
+
+    check = _Check()
+    if size:
+        with open(path, 'rb') as f:
+            while size > 0:
+                chunk = f.read(min(CHUNK_SIZE, size))
+                if not chunk:
+                    break
+                check.update(chunk)
+                size -= len(chunk)
+    return check
+
+
+def _entry(url, path, size, headers, check):
+    "Return the manifest entry of some completed and verified download."
+
+    return Entry(url, os.path.basename(path), size, headers.get('ETag'),
+        headers.get('Last-Modified'), check.sha.hexdigest(), time.time(),
+        True)
+
+
+def _restore(url, path, store):
+    "Link the stored file of some URL to some path, returning its entry."
+
+    stored = store.get(url)
+    if stored is None:
+        return None
+    sha256, size, etag, last_modified = stored
+    store.link(sha256, path)
+    # Files are verified before they are stored.
+    return Entry(url, os.path.basename(path), size, etag, last_modified,
+        sha256, time.time(), True)
+
+
+def _completed(entry, path, manifest=None, store=None):
+    "Store the file of a completed download, and record it."
+
+    if store is not None:
+        store.add(entry, path)
+    if manifest is not None:
+        manifest.add(entry)
+
+
+def _known(url, path, manifest=None, refresh=False):
+    "Return the manifest entry of some URL to refresh, if any."
+
+    if not refresh or manifest is None or not os.path.exists(path):
+        return None
+    return manifest.get(url)
+
+
+def _conditional(headers, offset, known):
+    "Add headers asking for a known download only if it changed since."
+
+    if known is None or offset:
+        return
+    if known.etag:
+        headers['If-None-Match'] = known.etag
+    if known.last_modified:
+        headers['If-Modified-Since'] = known.last_modified
+
+
+def _adopt(url, path, manifest):
+    """Record a file downloaded before there was a manifest, if complete.
+
+    The file is hashed and checked once, and if it is no complete PDF,
+    it is not recorded, and False is returned, to download it again. As
+    its size cannot be checked without asking the server, its entry has
+    a verified value of None.
+    """
+    size = os.path.getsize(path)
+    check = _digest(path, size)
+    if check.error(path) is not None:
+        return False
+    manifest.add(Entry(url, os.path.basename(path), size, None, None,
+        check.sha.hexdigest(), os.path.getmtime(path), None))
+    return True
+
+
+def _done(url, path, overwrite=False, manifest=None, refresh=False):
+    """Return if some URL is downloaded already.
+
+    URLs in the manifest, if any, are done without checking their files,
+    unless refreshing, when ones with their file gone are dropped from it.
+    Other files found are added to it, if complete.
+    """
+    if overwrite:
+        return False
+    if manifest is not None:
+        if url in manifest:
+            if refresh and not os.path.exists(path):
+                manifest.remove(url)
+                return False
+            return True
+        return os.path.exists(path) and _adopt(url, path, manifest)
+    return os.path.exists(path)
+
+
+def _report(path, entry, known=None):
+    "Print if some file was saved, or found unchanged since last time."
+
+    if known is not None and entry.sha256 == known.sha256:
+        print('unchanged %s' % path)
+    else:
+        print('saved %s (%d bytes)' % (path, entry.size))
+
+
+def _stale(path, age):
+    "Return if a temporary file in some folder is left by an earlier run."
+
+    name = os.path.basename(path)
+    if name.endswith('.part.validator'):
+        return not os.path.exists(path[:-len('.validator')])
+    if not name.endswith(('.segments', '.link', '.part')):
+        return False
+    stat = os.stat(path)
+    if time.time() - stat.st_mtime < age:
+        return False
+    if name.endswith('.part'):
+        return stat.st_size == 0 or os.path.exists(path[:-len('.part')])
+    return True
+
+
+def sweep(dest='.', verbose=False, age=STALE_AGE, store=None):
+    """Remove stale temporary files left in some folder by earlier runs.
+
+    Segmented downloads and links from a store cannot be resumed, and
+    neither can empty partial downloads, or ones of files complete
+    already. Other partial downloads are kept for resuming them. Files
+    written to within some age in seconds are kept, too, as they may
+    belong to other processes downloading into the same folder. Given a
+    store, its stale temporary files are removed, too.
+    """
+    if store is not None:
+        store.sweep(age, verbose=verbose)
+    if not os.path.isdir(dest):
+        return
+    for name in os.listdir(dest):
+        path = os.path.join(dest, name)
+        try:
+            if not _stale(path, age):
+                continue
+            os.remove(path)
+        except FileNotFoundError:
+            continue  # finished by another process meanwhile
+        if verbose:
+            print('removed stale %s' % path)
+
 
 # sequential
 
-def get_cats_sync(full_urls=False, verbose=False):
+_session = None
+
+
+def make_session(pool_size=10):
+    "Return a requests session keeping a pool of connections alive per host."
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(
+        pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get_session():
+    "Return the session shared by all sync functions, created on first use."
+
+    global _session
+    if _session is None:
+        _session = make_session()
+    return _session
+
+
+def _iter_content(response, chunk_size, deadline, rates=None):
+    """Generate the body of some streamed response in chunks, up to a deadline.
+
+    Given rate limits, each chunk waits until it fits into the bandwidth.
+    """
+    for chunk in response.iter_content(chunk_size):
+        if deadline and time.monotonic() > deadline:
+            raise requests.Timeout('total timeout reading %s' % response.url)
+        if rates is not None:
+            rates.received(response.url, len(chunk))
+        yield chunk
+
+
+def get_cats_sync(full_urls=False, verbose=False, session=None, retry=None,
+    failed=None, timeout=TIMEOUT, connect_timeout=CONNECT_TIMEOUT,
+    read_timeout=READ_TIMEOUT, cache=None, rates=None):
     "Generate category URLs for free O'Reilly ebooks."
 
-    base_url = 'http://shop.oreilly.com'
-    url = base_url + '/category/ebooks.do'
+    crawl = _Crawl(session or get_session(), retry=retry,
+        timeouts=Timeouts(timeout, connect_timeout, read_timeout),
+        cache=cache, failed=failed, verbose=verbose, rates=rates)
+    url = SHOP_URL + '/category/ebooks.do'
     if verbose:
         print(url)
-    p = etree.HTMLParser()
-    tree = etree.parse(url, parser=p)
-    xpath_expr = '//a[starts-with(@href, "/category/ebooks/")]/@href'
-    cat_urls = tree.xpath(xpath_expr)
-    cat_urls = [base_url + u for u in cat_urls if u.endswith('.do')]
+    cat_urls = [SHOP_URL + u for u in crawl.extract_sync(url, _cat_paths)]
     for u in cat_urls:
         if verbose:
             print(u)
-        tree1 = etree.parse(u, parser=p)
-        urls = tree1.xpath(xpath_expr)
-        for u in urls:
-            if not u.endswith('.do'):
-                continue
+        for path in crawl.extract_sync(u, _cat_paths):
             if full_urls:
-                yield base_url + u
+                yield SHOP_URL + path
             else:
-                pat = 'category/ebooks/(.*?).do'
-                yield re.findall(pat, u)[0]
+                yield _cat_name(path)
+
 
+def download_filelist_sync(cat, verbose=False, session=None, retry=None,
+    failed=None, timeout=TIMEOUT, connect_timeout=CONNECT_TIMEOUT,
+    read_timeout=READ_TIMEOUT, cache=None, state=None, rates=None,
+    shard=None):
+    """Generate URLs for free O'Reilly ebooks in PDF format.
 
-def download_filelist_sync(cat, verbose=False):
-    "Generate URLs for free O'Reilly ebooks in PDF format."
+    The category can also be a list of them, with products listed in more
+    than one fetched and their PDF URLs generated only once. Given a crawl
+    state, only product pages not resolved before are fetched. Given a
+    shard as (number, count), only product pages in it are fetched.
+    """
+    crawl = _Crawl(session or get_session(), retry=retry,
+        timeouts=Timeouts(timeout, connect_timeout, read_timeout),
+        cache=cache, failed=failed, verbose=verbose, state=state,
+        rates=rates, shard=shard)
+    for cat in _cat_list(cat):
+        url = SHOP_URL + '/category/ebooks/%s.do' % cat
+        if verbose:
+            print(url)
+        for page_url in crawl.extract_sync(url, _page_paths):
+            for path in crawl.extract_sync(SHOP_URL + page_url,
+                    _product_paths):
+                if not crawl.first(path) or not crawl.mine(path):
+                    continue
+                u = crawl.resolve_sync(path)
+                if u is None or not crawl.first(u):
+                    continue
+                if verbose:
+                    print(u)
+                yield u
+
+
+def _download_sync(session, url, path, chunk_size, retry, timeouts,
+    rates=None, known=None):
+    """Download a single URL into some path, resuming any partial download.
+
+    Return the manifest entry of the download, hashed and checked to be a
+    complete PDF while streaming, before it gets its final name. Given the
+    entry of an earlier download, the file is only fetched again if changed
+    since, else that entry is returned, completed now.
+    """
+    part = path + '.part'
+    offset, headers = _resume_headers(part)
+    _conditional(headers, offset, known)
+    if rates is not None:
+        rates.request(url)
+    deadline = _deadline(timeouts)
+    with session.get(url, headers=headers, stream=True,
+            timeout=(timeouts.connect, timeouts.read)) as response:
+        retry.check(url, response.status_code)
+        if response.status_code == 304 and known is not None:
+            return known._replace(completed=time.time())
+        offset, total = _resume_plan(url, part, response.status_code,
+            response.headers, offset)
+        check = _digest(part, offset)
+        if response.status_code != 416:
+            with open(part, mode='ab' if offset else 'wb') as f:
+                if not offset:
+                    _remember(part, response.headers)
+                for chunk in _iter_content(response, chunk_size, deadline,
+                        rates):
+                    f.write(chunk)
+                    check.update(chunk)
+    _finish_part(part, path, check.size, total, check)
+    return _entry(url, path, check.size, response.headers, check)
 
-    url = 'http://shop.oreilly.com/category/ebooks/%s.do' % cat
+
+def _fetch_sync(session, url, dest, overwrite, verbose, chunk_size, retry,
+    timeouts, rates=None, manifest=None, store=None, refresh=False):
+    "Download a single URL unless done already, returning False if it failed."
+
+    pdf_name = os.path.basename(url)
+    path = os.path.join(dest, pdf_name)
+    known = _known(url, path, manifest, refresh)
+    if known is None and _done(url, path, overwrite, manifest, refresh):
+        return True
+    # if verbose:
+    #     print(url)
+    if overwrite:
+        _discard(path + '.part')
+    # Failing to store or record a file fails only its URL, too.
+    try:
+        if store is not None and not overwrite and known is None:
+            entry = _restore(url, path, store)
+            if entry is not None:
+                _completed(entry, path, manifest)
+                if verbose:
+                    print('linked %s (%d bytes)' % (path, entry.size))
+                return True
+        entry = retry.call(
+            lambda: _download_sync(session, url, path, chunk_size, retry,
+                timeouts, rates, known),
+            SYNC_ERRORS, url=url, verbose=verbose)
+        _completed(entry, path, manifest, store)
+    except FAILURES as exc:
+        if verbose:
+            print('failed %s (%s)' % (url, exc))
+        return False
     if verbose:
-        print(url)
-    p = etree.HTMLParser()
-    t1 = etree.parse(url, parser=p)
-    table_pag1 = t1.xpath('//table[@class="pagination"]')[0]
-    xp = '//td[@class="default"]/select[@name="dirPage"]/option/@value'
-    page_urls = set(table_pag1.xpath(xp))
-    for i, page_url in enumerate(page_urls):
-        # if verbose:
-        #     print(page_url)
-        t2 = etree.parse('http://shop.oreilly.com' + page_url, parser=p)
-        xp = '//span[@class="price"][contains(., "$0.00")]/'\
-             '../../../../div[@class="thumbheader"]/a/@href'
-        paths = t2.xpath(xp)
-        for j, path in enumerate(paths):
-            url = 'http://shop.oreilly.com' + path
-            html = requests.get(url).text
-            url_csps = re.findall('path_info\:\s+(.*?\.csp)', html)
-            if len(url_csps) != 1:
-                continue
-            url_csp = url_csps[0]
-            url_csp = re.sub('\?.*', '', url_csp)
-            url_pdf = re.sub('\.csp', '.pdf', url_csp)
-            url_pdf = re.sub('/free/', '/free/files/', url_pdf)
-            u = 'http://www.oreilly.com/%s' % url_pdf
-            if verbose:
-                print(u)
-            yield u
-
-
-def download_files_sync(urls, dest='.', overwrite=False, verbose=False):
-    "Download a list of URLs sequentially (synchronuously)."
-
-    for url in urls:
-        pdf_name = os.path.basename(url)
-        path = os.path.join(dest, pdf_name)
-        if not os.path.exists(path) or overwrite:
-            # if verbose:
-            #     print(url)
-            response = requests.get(url)
-            pdf = response.content
-            # if verbose:
-            #     print('%s %d' % (url, len(pdf)))
-            open(path, mode='wb').write(pdf)
-            if verbose:
-                print('saved %s (%d bytes)' % (path, len(pdf)))
+        _report(path, entry, known)
+    return True
+
+
+def download_files_sync(urls, dest='.', overwrite=False, verbose=False,
+    session=None, chunk_size=CHUNK_SIZE, retry=None, timeout=TIMEOUT,
+    connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, rates=None,
+    manifest=None, store=None, refresh=False):
+    """Download a list of URLs sequentially (synchronuously).
+
+    Given rate limits, requests and bytes per second per host are capped.
+    Given a manifest, URLs recorded in it are skipped and completed ones
+    are added to it. If refreshing, recorded URLs are requested again, but
+    conditionally, so only files changed since are fetched. Given a store,
+    URLs in it are linked from it instead of fetched, and downloaded files
+    are added to it. Return the list of URLs that failed to download after
+    all retries.
+    """
+    # Files are written as <name>.part, synced and renamed once complete,
+    # so no partial PDF ever shows up under its final name, and an
+    # interrupted download is resumed on the next run or retry.
+    session = session or get_session()
+    retry = retry or RetryPolicy()
+    timeouts = Timeouts(timeout, connect_timeout, read_timeout)
+    sweep(dest, verbose=verbose, store=store)
+    return [url for url in urls
+        if not _fetch_sync(session, url, dest, overwrite, verbose,
+            chunk_size, retry, timeouts, rates, manifest, store, refresh)]
+
+
+# threaded
+
+def download_files_threaded(urls, dest='.', overwrite=False, verbose=False,
+    workers=CONCURRENCY, pool_size=10, chunk_size=CHUNK_SIZE, retry=None,
+    timeout=TIMEOUT, connect_timeout=CONNECT_TIMEOUT,
+    read_timeout=READ_TIMEOUT, rates=None, manifest=None, store=None,
+    refresh=False):
+    """Download a list of URLs in parallel, in a pool of threads.
+
+    Like download_files_sync, but with some number of workers, each one
+    with a session of its own, so only requests is needed. Return the list
+    of URLs that failed to download after all retries.
+    """
+    # Sessions are not thread-safe, so each thread gets its own one, kept
+    # for all its downloads. Manifest, store and rate limits are shared.
+    retry = retry or RetryPolicy()
+    timeouts = Timeouts(timeout, connect_timeout, read_timeout)
+    local = threading.local()
+    sessions = []
+    sweep(dest, verbose=verbose, store=store)
+
+    def fetch_one(url):
+        if not hasattr(local, 'session'):
+            local.session = make_session(pool_size)
+            sessions.append(local.session)
+        return _fetch_sync(local.session, url, dest, overwrite, verbose,
+            chunk_size, retry, timeouts, rates, manifest, store, refresh)
+
+    urls = list(urls)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(workers) as executor:
+            done = list(executor.map(fetch_one, urls))
+    finally:
+        for session in sessions:
+            session.close()
+    return [url for url, ok in zip(urls, done) if not ok]
 
 
 # parallel
 
-async def fetch(session, url, dest='.', overwrite=False, verbose=False):
-    "Fetch a single PDF file if not already existing."
+def _client_session(timeouts, limit_per_host=LIMIT_PER_HOST):
+    "Return an aiohttp session with given timeouts and connection limit."
+
+    timeout = aiohttp.ClientTimeout(total=timeouts.total,
+        sock_connect=timeouts.connect, sock_read=timeouts.read)
+    connector = aiohttp.TCPConnector(limit=0, limit_per_host=limit_per_host)
+    return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+
+def _merge_timeouts(session, timeout=None, connect_timeout=None,
+    read_timeout=None):
+    "Return the timeouts of some session, with any ones given replaced."
+
+    base = session.timeout
+    return aiohttp.ClientTimeout(
+        total=base.total if timeout is None else timeout,
+        connect=base.connect,
+        sock_connect=base.sock_connect if connect_timeout is None
+            else connect_timeout,
+        sock_read=base.sock_read if read_timeout is None else read_timeout)
+
+
+def _limits(concurrency, adaptive=False, max_concurrency=MAX_CONCURRENCY,
+    verbose=False):
+    """Return the limits of requests in flight for some async function.
+
+    Adaptive limits start at the given concurrency for each host, else the
+    concurrency is a fixed limit for all hosts.
+    """
+    if adaptive:
+        return HostLimits(ASYNC_ERRORS, concurrency, maximum=max_concurrency,
+            verbose=verbose)
+    return FixedLimit(concurrency)
+
+
+async def _crawl_cats(crawl, full_urls=False):
+    "Generate category URLs for free O'Reilly ebooks, as pages come in."
+
+    async def cat_paths(url):
+        paths = await crawl.extract(url, _cat_paths)
+        if crawl.verbose:
+            print(url)
+        return paths
+
+    url = SHOP_URL + '/category/ebooks.do'
+    if crawl.verbose:
+        print(url)
+    with crawl.parser_pool() as crawl.parser:
+        async with crawl.client_session() as crawl.session:
+            tasks = [asyncio.ensure_future(cat_paths(SHOP_URL + u))
+                for u in await crawl.extract(url, _cat_paths)]
+            try:
+                for task in asyncio.as_completed(tasks):
+                    for path in await task:
+                        yield SHOP_URL + path if full_urls \
+                            else _cat_name(path)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def get_cats_async(full_urls=False, verbose=False, concurrency=CONCURRENCY,
+    retry=None, failed=None, timeout=TIMEOUT, connect_timeout=CONNECT_TIMEOUT,
+    read_timeout=READ_TIMEOUT, limit_per_host=LIMIT_PER_HOST, cache=None,
+    parse_processes=PARSE_PROCESSES, adaptive=False,
+    max_concurrency=MAX_CONCURRENCY, rates=None, executor_size=EXECUTOR_SIZE):
+    """Generate category URLs for free O'Reilly ebooks, crawled in parallel.
+
+    Pages are parsed in a pool of parse processes, if given, else in a pool
+    of executor_size threads.
+    If adaptive, the concurrency is adapted like for fetch_async.
+    """
+    crawl = _Crawl(retry=retry,
+        timeouts=Timeouts(timeout, connect_timeout, read_timeout),
+        cache=cache, failed=failed, verbose=verbose, concurrency=concurrency,
+        limit_per_host=limit_per_host, parse_processes=parse_processes,
+        adaptive=adaptive, max_concurrency=max_concurrency, rates=rates)
+    return _iter_async(_crawl_cats(crawl, full_urls=full_urls),
+        executor_size=executor_size)
+
+
+async def _crawl_filelist(crawl, cats):
+    "Generate URLs for free O'Reilly ebooks in PDF format, as they resolve."
+
+    urls = [SHOP_URL + '/category/ebooks/%s.do' % cat
+        for cat in _cat_list(cats)]
+    if crawl.verbose:
+        for url in urls:
+            print(url)
+    # Bounded queues, so a slow consumer of the URLs slows down the crawl.
+    size = crawl.queue_size or 2 * crawl.workers
+    products = asyncio.Queue(size)
+    pdf_urls = asyncio.Queue(size)
+
+    async def list_pages():
+        page_urls = set()
+        for task in asyncio.as_completed([crawl.extract(url, _page_paths)
+                for url in urls]):
+            page_urls.update(await task)
+        return sorted(page_urls)
+
+    async def list_products(pages):
+        for task in asyncio.as_completed(pages):
+            for path in await task:
+                if crawl.first(path) and crawl.mine(path):
+                    await products.put(path)
+
+    async def resolve_products():
+        while True:
+            path = await products.get()
+            if path is None:
+                break
+            u = await crawl.resolve(path)
+            if u and crawl.first(u):
+                await pdf_urls.put(u)
+
+    async def run():
+        try:
+            pages = [asyncio.ensure_future(
+                crawl.extract(SHOP_URL + u, _product_paths))
+                for u in await list_pages()]
+            workers = [asyncio.ensure_future(resolve_products())
+                for i in range(crawl.workers)]
+            try:
+                await list_products(pages)
+                for worker in workers:
+                    await products.put(None)
+                await asyncio.gather(*workers)
+            finally:
+                for task in pages + workers:
+                    task.cancel()
+                await asyncio.gather(*(pages + workers),
+                    return_exceptions=True)
+        finally:
+            await pdf_urls.put(None)
+
+    with crawl.parser_pool() as crawl.parser:
+        async with crawl.client_session() as crawl.session:
+            crawler = asyncio.ensure_future(run())
+            try:
+                while True:
+                    u = await pdf_urls.get()
+                    if u is None:
+                        break
+                    if crawl.verbose:
+                        print(u)
+                    yield u
+                await crawler
+            finally:
+                crawler.cancel()
+                await asyncio.gather(crawler, return_exceptions=True)
+
+
+def download_filelist_async(cat, verbose=False, concurrency=CONCURRENCY,
+    retry=None, failed=None, timeout=TIMEOUT, connect_timeout=CONNECT_TIMEOUT,
+    read_timeout=READ_TIMEOUT, limit_per_host=LIMIT_PER_HOST, cache=None,
+    state=None, parse_processes=PARSE_PROCESSES, adaptive=False,
+    max_concurrency=MAX_CONCURRENCY, rates=None, shard=None,
+    executor_size=EXECUTOR_SIZE):
+    """Generate URLs for free O'Reilly ebooks in PDF format, crawled in parallel.
+
+    The category can also be a list of them, like for download_filelist_sync.
+    Given a crawl state, only product pages not resolved before are fetched,
+    and given a shard, only those in it, like for download_filelist_sync.
+    Pages are parsed in a pool of parse processes, if given, else in a pool
+    of executor_size threads.
+    If adaptive, the concurrency is adapted like for fetch_async.
+    """
+    crawl = _Crawl(retry=retry,
+        timeouts=Timeouts(timeout, connect_timeout, read_timeout),
+        cache=cache, failed=failed, verbose=verbose, concurrency=concurrency,
+        limit_per_host=limit_per_host, state=state,
+        parse_processes=parse_processes, adaptive=adaptive,
+        max_concurrency=max_concurrency, rates=rates, shard=shard)
+    return _iter_async(_crawl_filelist(crawl, cat),
+        executor_size=executor_size)
+
+
+async def fetch(session, url, dest='.', overwrite=False, verbose=False,
+    chunk_size=CHUNK_SIZE, retry=None, timeout=None, connect_timeout=None,
+    read_timeout=None, limits=None, rates=None, segments=SEGMENTS,
+    segment_threshold=SEGMENT_THRESHOLD, manifest=None, store=None,
+    refresh=False):
+    """Fetch a single PDF file if not already existing.
+
+    Timeouts not given are taken from the session. Given limits, the
+    request waits for one of the slots these allow for its host, and
+    given rate limits, for its requests and bytes to fit into these.
+    Files larger than the segment threshold are fetched in that many
+    segments in parallel, if the server accepts ranges, each taking a slot
+    of its own, once the first response is dropped. Given a manifest,
+    URLs recorded in it are skipped and completed ones are added to it.
+    If refreshing, a recorded URL is requested again, but conditionally.
+    Given a store, a URL in it is linked from it instead of fetched, and
+    a downloaded file is added to it. Return the manifest entry of the
+    download, or None if skipped.
+    """
 
     pdf_name = os.path.basename(url)
     path = os.path.join(dest, pdf_name)
-    if not os.path.exists(path) or overwrite:
+    loop = asyncio.get_event_loop()
+    known = _known(url, path, manifest, refresh)
+    if known is not None or not await loop.run_in_executor(None, _done, url,
+            path, overwrite, manifest, refresh):
         # if verbose:
         #     print(url)
-        with aiohttp.Timeout(60, loop=session.loop):
-            async with session.get(url) as response:
-                pdf = await response.read()
-                # if verbose:
-                #     print('%s %d' % (url, len(pdf)))
-                async with aiofiles.open(path, mode='wb') as f:
-                    await f.write(pdf)
-                    if verbose:
-                        print('saved %s (%d bytes)' % (path, len(pdf)))
+        if store is not None and not overwrite and known is None:
+            entry = await loop.run_in_executor(None, _restore, url, path,
+                store)
+            if entry is not None:
+                await loop.run_in_executor(None, _completed, entry, path,
+                    manifest)
+                if verbose:
+                    print('linked %s (%d bytes)' % (path, entry.size))
+                return entry
+        part = path + '.part'
+        offset, headers = _resume_headers(part)
+        _conditional(headers, offset, known)
+        kwargs = {}
+        if timeout or connect_timeout or read_timeout:
+            kwargs['timeout'] = _merge_timeouts(session, timeout,
+                connect_timeout, read_timeout)
+        rates = rates or RateLimits()
+        await rates.request_async(url)
+        limits = limits or FixedLimit()
+        async with limits.slot(url) as slot, \
+                session.get(url, headers=headers, **kwargs) as response:
+            slot.responded()
+            if retry:
+                retry.check(url, response.status)
+            if response.status == 304 and known is not None:
+                entry = known._replace(completed=time.time())
+                await loop.run_in_executor(None, _completed, entry, path,
+                    manifest)
+                if verbose:
+                    _report(path, entry, known)
+                return entry
+            offset, total = _resume_plan(url, part, response.status,
+                response.headers, offset)
+            segmented = segments > 1 and not offset and total is not None \
+                and total > segment_threshold and hasattr(os, 'pwrite') and \
+                response.headers.get('Accept-Ranges') == 'bytes'
+            if segmented:
+                # Drop this response, and its slot, for as many range
+                # requests, which need connections and slots of their own.
+                response.close()
+            else:
+                check = await loop.run_in_executor(None, _digest, part,
+                    offset)
+            if not segmented and response.status != 416:
+                async with aiofiles.open(part,
+                        mode='ab' if offset else 'wb') as f:
+                    if not offset:
+                        await loop.run_in_executor(None, _remember, part,
+                            response.headers)
+                    async for chunk in \
+                            response.content.iter_chunked(chunk_size):
+                        await f.write(chunk)
+                        check.update(chunk)
+                        await rates.received_async(url, len(chunk))
+        if segmented:
+            check = await _fetch_segments(session, url, path, total,
+                segments, chunk_size, kwargs, retry, rates,
+                _validator(response.headers), limits)
+            _discard(part)
+            size = check.size
+            entry = _entry(url, path, size, response.headers, check)
+            await loop.run_in_executor(None, _completed, entry, path,
+                manifest, store)
+            if verbose:
+                print('saved %s (%d bytes in %d segments)' % (path, size,
+                    segments))
+            return entry
+        size = check.size
+        await loop.run_in_executor(None, _finish_part, part, path, size, total,
+            check)
+        entry = _entry(url, path, size, response.headers, check)
+        await loop.run_in_executor(None, _completed, entry, path, manifest,
+            store)
+        if verbose:
+            _report(path, entry, known)
+        return entry
+
 
+def _segment_ranges(total, segments):
+    "Return first and last bytes of some number of segments of a size."
 
-async def fetch_async(loop, urls, dest='.', overwrite=False, verbose=False):
-    "Download a list of URLs in parallel (asynchronuously)."
+    size = -(-total // segments)
+    return [(start, min(start + size, total) - 1)
+        for start in range(0, total, size)]
 
-    async with aiohttp.ClientSession(loop=loop) as session:
-        tasks = [fetch(session, url, 
-            dest=dest, overwrite=overwrite, verbose=verbose) for url in urls]
-        await asyncio.gather(*tasks)
 
+async def _fetch_segment(session, url, fd, start, end, chunk_size, kwargs,
+    retry, rates, validator=None, limits=None):
+    """Fetch a range of bytes of some URL, writing them at their file position.
+
+    Given a validator, the range must be of that version of the file, and
+    given limits, the request takes one of their slots, like for fetch.
+    """
+    loop = asyncio.get_event_loop()
+    headers = {'Accept-Encoding': 'identity',
+        'Range': 'bytes=%d-%d' % (start, end)}
+    if validator:
+        headers['If-Range'] = validator
+    await rates.request_async(url)
+    async with (limits or FixedLimit()).slot(url) as slot, \
+            session.get(url, headers=headers, **kwargs) as response:
+        slot.responded()
+        if retry:
+            retry.check(url, response.status)
+        if response.status >= 400:
+            raise IOError('HTTP status %d for %s' % (response.status, url))
+        # Anything but the range asked for, like all of a file changed since
+        # the first response, means fetching it again from scratch.
+        m = _content_range_re.match(response.headers.get('Content-Range', ''))
+        if response.status != 206 or not m or m.group(1) != str(start):
+            raise TransientError('unexpected range %r for %s' % (
+                response.headers.get('Content-Range'), url))
+        pos = start
+        async for chunk in response.content.iter_chunked(chunk_size):
+            chunk = chunk[:end + 1 - pos]
+            await loop.run_in_executor(None, os.pwrite, fd, chunk, pos)
+            pos += len(chunk)
+            await rates.received_async(url, len(chunk))
+    if pos != end + 1:
+        raise TransientError('incomplete segment of %s (%d of %d bytes)' % (
+            url, pos - start, end + 1 - start))
 
-def download_files_async(urls, dest='.', overwrite=False, verbose=False):
-    "Build and execute async. event loop for downloading a list of URLs."
 
-    # This can produce timeouts which are cached and worked around, which 
-    # slows down the process. It's not very clear how to best select the 
-    # chunk size and number of workers for the ThreadPoolExecutor, both
-    # hardcoded below.
+async def _fetch_segments(session, url, path, total, segments, chunk_size,
+    kwargs, retry, rates, validator=None, limits=None):
+    """Fetch some URL in segments in parallel into a preallocated file.
 
+    A failing segment fails all of them, and a retry starts from scratch,
+    as it does if the file changes, given the validator of its version.
+    Given limits, each segment takes a slot of its own. Return the check
+    of the file, done before it gets its final name.
+    """
     loop = asyncio.get_event_loop()
-    executor = concurrent.futures.ThreadPoolExecutor(20)
-    loop.set_default_executor(executor)
-    while urls:
-        chunk, urls = urls[:10], urls[10:]
+    tmp = path + '.segments'
+    fd = os.open(tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o666)
+    try:
+        try:
+            os.posix_fallocate(fd, 0, total)
+        except (AttributeError, OSError):
+            os.ftruncate(fd, total)
+        tasks = [asyncio.ensure_future(_fetch_segment(session, url, fd,
+            start, end, chunk_size, kwargs, retry, rates, validator, limits))
+            for start, end in _segment_ranges(total, segments)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    finally:
+        os.close(fd)
+    # Segments arrive out of order, so check them once all are written.
+    check = await loop.run_in_executor(None, _digest, tmp, total)
+    await loop.run_in_executor(None, _finish_part, tmp, path, check.size,
+        total, check)
+    return check
+
+
+async def fetch_async(urls, dest='.', overwrite=False, verbose=False,
+    concurrency=CONCURRENCY, chunk_size=CHUNK_SIZE, retry=None,
+    queue_size=None, timeout=TIMEOUT, connect_timeout=CONNECT_TIMEOUT,
+    read_timeout=READ_TIMEOUT, limit_per_host=LIMIT_PER_HOST, adaptive=False,
+    max_concurrency=MAX_CONCURRENCY, rates=None, segments=SEGMENTS,
+    segment_threshold=SEGMENT_THRESHOLD, manifest=None, store=None,
+    refresh=False):
+    """Download a list of URLs in parallel (asynchronuously).
+
+    The URLs can also come from an async iterable, e.g. a crawler still
+    discovering them, in which case downloads start with the first URL.
+    If adaptive, the concurrency per host starts at the given one and is
+    adapted between 1 and max_concurrency. Given rate limits, requests and
+    bytes per second per host are capped. Files larger than the segment
+    threshold are fetched in segments, like for fetch. URLs recorded in
+    the manifest, if given, are not even queued, unless refreshing, and
+    given a store, it is used like for fetch. Return the list of URLs that
+    failed to download after all retries.
+    """
+    # Workers share one bounded queue, so each one starts on the next URL
+    # as soon as it is done with its current one. Retries resume from the
+    # bytes already written to <name>.part.
+    sweep(dest, verbose=verbose, store=store)
+    limits = _limits(concurrency, adaptive, max_concurrency, verbose)
+    workers = max_concurrency if adaptive else concurrency
+    queue = asyncio.Queue(queue_size or 2 * workers)
+    retry = retry or RetryPolicy()
+    failed = []
+
+    def pending(url):
+        return overwrite or refresh or manifest is None or \
+            url not in manifest
+
+    async def feed():
+        try:
+            if hasattr(urls, '__aiter__'):
+                async for url in urls:
+                    if pending(url):
+                        await queue.put(url)
+            else:
+                for url in urls:
+                    if pending(url):
+                        await queue.put(url)
+        finally:
+            for i in range(workers):
+                await queue.put(None)
+
+    async def worker(session):
         while True:
-            try:
-                loop.run_until_complete(fetch_async(loop, chunk, 
-                    dest=dest, overwrite=overwrite, verbose=verbose))
+            url = await queue.get()
+            if url is None:
                 break
-            except concurrent.futures._base.TimeoutError:
-                print('retrying...')
-    executor.shutdown(wait=True)
-    loop.close()
+            if overwrite:
+                # Retries resume from the partial file, earlier runs not.
+                _discard(os.path.join(dest, os.path.basename(url)) + '.part')
+            try:
+                await retry.call_async(
+                    lambda: fetch(session, url,
+                        dest=dest, overwrite=overwrite, verbose=verbose,
+                        chunk_size=chunk_size, retry=retry, limits=limits,
+                        rates=rates, segments=segments,
+                        segment_threshold=segment_threshold,
+                        manifest=manifest, store=store, refresh=refresh),
+                    ASYNC_ERRORS, url=url, verbose=verbose)
+            except FAILURES as exc:
+                if verbose:
+                    print('failed %s (%s)' % (url, exc))
+                failed.append(url)
+
+    timeouts = Timeouts(timeout, connect_timeout, read_timeout)
+    async with _client_session(timeouts, limit_per_host) as session:
+        tasks = [asyncio.ensure_future(feed())] + [
+            asyncio.ensure_future(worker(session))
+            for i in range(workers)]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+    return failed
+
+
+def _run_async(coro, executor_size=EXECUTOR_SIZE):
+    "Build and execute an async. event loop running some coroutine."
+
+    # The default executor runs the file operations of aiofiles.
+    loop = asyncio.new_event_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(executor_size)
+    loop.set_default_executor(executor)
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.run_until_complete(loop.shutdown_asyncgens())
+        executor.shutdown(wait=True)
+        loop.close()
+
+
+def download_files_async(urls, dest='.', overwrite=False, verbose=False,
+    concurrency=CONCURRENCY, chunk_size=CHUNK_SIZE, retry=None,
+    timeout=TIMEOUT, connect_timeout=CONNECT_TIMEOUT,
+    read_timeout=READ_TIMEOUT, limit_per_host=LIMIT_PER_HOST,
+    executor_size=EXECUTOR_SIZE, adaptive=False,
+    max_concurrency=MAX_CONCURRENCY, rates=None, segments=SEGMENTS,
+    segment_threshold=SEGMENT_THRESHOLD, manifest=None, store=None,
+    refresh=False):
+    """Build and execute async. event loop for downloading a list of URLs.
+
+    If adaptive, the concurrency is adapted, given rate limits, requests
+    and bytes are capped, large files are fetched in segments, and given a
+    manifest and store, these are used like for fetch_async, also when
+    refreshing. Return the list of URLs that failed to download after all
+    retries.
+    """
+    # Timeouts and other transient errors are retried per URL, with
+    # backoff, as given by the retry policy.
+    return _run_async(fetch_async(urls,
+        dest=dest, overwrite=overwrite, verbose=verbose,
+        concurrency=concurrency, chunk_size=chunk_size, retry=retry,
+        timeout=timeout, connect_timeout=connect_timeout,
+        read_timeout=read_timeout, limit_per_host=limit_per_host,
+        adaptive=adaptive, max_concurrency=max_concurrency, rates=rates,
+        segments=segments, segment_threshold=segment_threshold,
+        manifest=manifest, store=store, refresh=refresh),
+        executor_size=executor_size)
+
+
+def download_cat_async(cat, dest='.', overwrite=False, verbose=False,
+    concurrency=CONCURRENCY, chunk_size=CHUNK_SIZE, retry=None,
+    queue_size=None, failed=None, timeout=TIMEOUT,
+    connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT,
+    limit_per_host=LIMIT_PER_HOST, executor_size=EXECUTOR_SIZE, cache=None,
+    state=None, parse_processes=PARSE_PROCESSES, adaptive=False,
+    max_concurrency=MAX_CONCURRENCY, rates=None, segments=SEGMENTS,
+    segment_threshold=SEGMENT_THRESHOLD, manifest=None, store=None,
+    refresh=False, shard=None):
+    """Crawl one or more categories and download their PDFs in one run.
+
+    PDF URLs are passed through bounded queues of queue_size to the
+    download workers as soon as the crawler resolves them, so both phases
+    overlap, and the crawl waits while downloads lag behind. Given a
+    shard, only the products in it are crawled. Return the list of URLs
+    that failed to download after all retries. Pages failing to be crawled
+    are added to the failed list, if one is given.
+    """
+    crawl = _Crawl(retry=retry,
+        timeouts=Timeouts(timeout, connect_timeout, read_timeout),
+        cache=cache, failed=failed, verbose=verbose, concurrency=concurrency,
+        limit_per_host=limit_per_host, state=state,
+        parse_processes=parse_processes, adaptive=adaptive,
+        max_concurrency=max_concurrency, rates=rates, shard=shard,
+        queue_size=queue_size)
+    urls = _crawl_filelist(crawl, cat)
+    return _run_async(fetch_async(urls,
+        dest=dest, overwrite=overwrite, verbose=verbose,
+        concurrency=concurrency, chunk_size=chunk_size, retry=retry,
+        queue_size=queue_size, timeout=timeout,
+        connect_timeout=connect_timeout, read_timeout=read_timeout,
+        limit_per_host=limit_per_host, adaptive=adaptive,
+        max_concurrency=max_concurrency, rates=rates, segments=segments,
+        segment_threshold=segment_threshold, manifest=manifest, store=store,
+        refresh=refresh), executor_size=executor_size)
@@ -0,0 +1,249 @@
+"""
+Limits on the number of requests in flight at a time, fixed or adaptive,
+and on the rate of requests and bytes per second.
+
+An adaptive limit raises the number of requests to a host by about one per
+round trip while responses come back about as fast as the fastest seen so
+far, and halves it on timeouts, throttling (429) or server errors (5xx),
+like the additive increase, multiplicative decrease (AIMD) of TCP
+congestion control. Like TCP, it starts by doubling the limit per round
+trip until the first error. Each host gets its own limit.
+
+Rate limits are token buckets per host, which requests and received bytes
+take tokens from. Tokens are reserved without waiting for each other, so
+requests fitting into the budget are never serialized.
+"""
+
+import time
+import asyncio
+import threading
+import contextlib
+from urllib.parse import urlsplit
+
+
+MAX_CONCURRENCY = 64
+
+# Latencies below this are treated as equal, so local servers answering
+# in no time do not make any jitter look like congestion.
+MIN_LATENCY = 0.01
+
+
+class _Slot(object):
+    "One request in flight, timing how long its response takes."
+
+    def __init__(self):
+        self.start = time.monotonic()
+        self.latency = None
+
+    def responded(self):
+        "Mark the response headers as received."
+
+        self.latency = time.monotonic() - self.start
+
+
+class FixedLimit(object):
+    "A fixed limit of requests in flight to all hosts, None for no limit."
+
+    def __init__(self, concurrency=None):
+        self.concurrency = concurrency
+        self._semaphore = None
+
+    @contextlib.asynccontextmanager
+    async def slot(self, url):
+        "Hold one of the requests allowed in flight while in this context."
+
+        if self.concurrency is None:
+            yield _Slot()
+            return
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        async with self._semaphore:
+            yield _Slot()
+
+
+class AdaptiveLimit(object):
+    "A limit of requests in flight to one host, adapted to how it responds."
+
+    def __init__(self, host, errors, initial, minimum=1,
+        maximum=MAX_CONCURRENCY, decrease=0.5, slow=2.0, verbose=False):
+        self.host = host
+        self.errors = errors
+        self.limit = float(min(max(initial, minimum), maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.slow = slow
+        self.verbose = verbose
+        self.in_flight = 0
+        self.base_latency = None
+        self.slow_start = True
+        self._decreased = 0
+        self._condition = None
+
+    @contextlib.asynccontextmanager
+    async def slot(self, url=None):
+        """Hold one of the requests allowed in flight while in this context.
+
+        Any of the given errors raised in the context count as congestion.
+        """
+        await self._acquire()
+        slot = _Slot()
+        try:
+            yield slot
+        except self.errors:
+            self._failed(slot)
+            raise
+        else:
+            self._succeeded(slot)
+        finally:
+            await self._release()
+
+    async def _acquire(self):
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            while self.in_flight >= int(self.limit):
+                await self._condition.wait()
+            self.in_flight += 1
+
+    async def _release(self):
+        async with self._condition:
+            self.in_flight -= 1
+            self._condition.notify_all()
+
+    def _succeeded(self, slot):
+        "Raise the limit if it is used up and the host responds fast."
+
+        latency = slot.latency
+        if latency is None:
+            latency = time.monotonic() - slot.start
+        latency = max(latency, MIN_LATENCY)
+        if self.base_latency is None or latency < self.base_latency:
+            self.base_latency = latency
+        # Only grow a limit actually used, else it would grow without bound.
+        if latency <= self.slow * self.base_latency and \
+                self.in_flight >= int(self.limit):
+            step = 1 if self.slow_start else 1 / self.limit
+            self._set(min(self.maximum, self.limit + step))
+
+    def _failed(self, slot):
+        "Cut the limit, once for all requests in flight when it was cut last."
+
+        if slot.start < self._decreased:
+            return
+        self._decreased = time.monotonic()
+        self.slow_start = False
+        self._set(max(self.minimum, self.limit * self.decrease))
+
+    def _set(self, limit):
+        if self.verbose and int(limit) != int(self.limit):
+            print('concurrency for %s: %d' % (self.host, int(limit)))
+        self.limit = limit
+
+
+class HostLimits(object):
+    "Adaptive limits of requests in flight, one for each host requested."
+
+    def __init__(self, errors, initial, maximum=MAX_CONCURRENCY,
+        verbose=False):
+        self.errors = errors
+        self.initial = initial
+        self.maximum = maximum
+        self.verbose = verbose
+        self.hosts = {}
+
+    def slot(self, url):
+        "Hold one of the requests allowed to the host of some URL."
+
+        host = urlsplit(url).netloc
+        if host not in self.hosts:
+            self.hosts[host] = AdaptiveLimit(host, self.errors, self.initial,
+                maximum=self.maximum, verbose=self.verbose)
+        return self.hosts[host].slot(url)
+
+
+class TokenBucket(object):
+    "Tokens refilled at some rate per second, up to a burst of them."
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def reserve(self, n=1):
+        """Take some tokens, returning the seconds until they are due.
+
+        Tokens can be taken ahead of time, so a number larger than the
+        burst just has to be waited for longer.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst,
+                self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= n
+            return max(0.0, -self.tokens / self.rate)
+
+
+class RateLimits(object):
+    """Limits of requests and bytes per second, for each host requested.
+
+    Both sync and async callers can share one instance, also across threads.
+    """
+
+    def __init__(self, max_rps=None, max_bandwidth=None):
+        self.max_rps = max_rps
+        self.max_bandwidth = max_bandwidth
+        self.hosts = {}
+        self._lock = threading.Lock()
+
+    def _buckets(self, url):
+        "Return the request and byte buckets of the host of some URL."
+
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self.hosts:
+                self.hosts[host] = (
+                    TokenBucket(self.max_rps) if self.max_rps else None,
+                    TokenBucket(self.max_bandwidth)
+                        if self.max_bandwidth else None)
+            return self.hosts[host]
+
+    def _delay(self, url, requests=0, nbytes=0):
+        rps, bandwidth = self._buckets(url)
+        delay = 0.0
+        if rps and requests:
+            delay = max(delay, rps.reserve(requests))
+        if bandwidth and nbytes:
+            delay = max(delay, bandwidth.reserve(nbytes))
+        return delay
+
+    def request(self, url):
+        "Wait until a request to some URL fits into the rate limits."
+
+        delay = self._delay(url, requests=1)
+        if delay:
+            time.sleep(delay)
+
+    async def request_async(self, url):
+        "Like request, but waiting asynchronously."
+
+        delay = self._delay(url, requests=1)
+        if delay:
+            await asyncio.sleep(delay)
+
+    def received(self, url, nbytes):
+        "Wait until some bytes received from some URL fit into the limits."
+
+        delay = self._delay(url, nbytes=nbytes)
+        if delay:
+            time.sleep(delay)
+
+    async def received_async(self, url, nbytes):
+        "Like received, but waiting asynchronously."
+
+        delay = self._delay(url, nbytes=nbytes)
+        if delay:
+            await asyncio.sleep(delay)
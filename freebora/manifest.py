@@ -0,0 +1,70 @@
+"""
+A persistent record of completed downloads in some destination folder.
+
+Maps each downloaded URL to the name, size, ``ETag``, ``Last-Modified``
+header and SHA-256 of its file, when it was completed, and if it was
+verified to be a complete PDF, unknown (None) for files found without
+being downloaded. All entries are loaded into memory once, so deciding
+what is left to download takes no stat calls, and entries are written
+through as downloads finish.
+"""
+
+import sqlite3
+import threading
+import collections
+
+
+Entry = collections.namedtuple('Entry',
+    'url filename size etag last_modified sha256 completed verified')
+
+
+class Manifest(object):
+    "An SQLite record of completed downloads, kept in memory, too."
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        # Shards in other processes may write to the same manifest.
+        self._db = sqlite3.connect(path, timeout=60,
+            check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS files ('
+            'url TEXT PRIMARY KEY, filename TEXT, size INTEGER, etag TEXT, '
+            'last_modified TEXT, sha256 TEXT, completed REAL, '
+            'verified INTEGER)')
+        self._db.commit()
+        self.entries = dict((row[0], Entry(*row)) for row in self._db.execute(
+            'SELECT url, filename, size, etag, last_modified, sha256, '
+            'completed, verified FROM files'))
+
+    def __contains__(self, url):
+        return url in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, url):
+        "Return the entry of some downloaded URL, or None."
+
+        return self.entries.get(url)
+
+    def add(self, entry):
+        "Record a completed download."
+
+        with self._lock:
+            self.entries[entry.url] = entry
+            self._db.execute('INSERT OR REPLACE INTO files VALUES '
+                '(?, ?, ?, ?, ?, ?, ?, ?)', entry)
+            self._db.commit()
+
+    def remove(self, url):
+        "Forget the download of some URL, if recorded."
+
+        with self._lock:
+            self.entries.pop(url, None)
+            self._db.execute('DELETE FROM files WHERE url = ?', (url,))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
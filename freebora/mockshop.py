@@ -0,0 +1,291 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+A local stand-in for the O'Reilly online shop, for tests and benchmarks.
+
+It serves synthetic category, pagination and product pages with the same
+markup freebora crawls on http://shop.oreilly.com, plus the PDF files these
+pages point to, with configurable latency, bandwidth and number of books.
+Point freebora at it by setting ``freebora.freebora.SHOP_URL`` and
+``PDF_URL`` to its URL, or use it as a context manager::
+
+    with MockShop(books=50, latency=0.05) as shop:
+        ...
+"""
+
+import re
+import time
+import asyncio
+import hashlib
+import argparse
+import threading
+import collections
+
+from aiohttp import web
+
+
+CATS = {
+    'data': ['data/big-data', 'data/data-science'],
+    'design': ['design/ux'],
+    'programming': ['programming/python', 'programming/javascript'],
+}
+
+
+class MockShop(object):
+    "A stand-in shop server running its own event loop in a thread."
+
+    def __init__(self, books=30, per_page=10, pdf_size=100 * 1024,
+        latency=0.0, bandwidth=None, capacity=None, cats=CATS,
+        host='127.0.0.1', port=0):
+        self.books = books
+        self.per_page = per_page
+        self.pdf_size = pdf_size
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.capacity = capacity
+        self.in_flight = 0
+        self.cats = cats
+        self.host = host
+        self.port = port
+        self.hits = collections.Counter()
+        self.log = []
+        self.bytes_sent = 0
+        self.last_modified = time.strftime('%a, %d %b %Y %H:%M:%S GMT',
+            time.gmtime())
+        self._loop = None
+        self._thread = None
+        self._index()
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % (self.host, self.port)
+
+    def _index(self):
+        "Assign books to categories, listing some in a second one, too."
+
+        leaves = sorted(sub for subs in self.cats.values() for sub in subs)
+        self.book_cats = {}
+        for i in range(self.books):
+            cats = [leaves[i % len(leaves)]]
+            if i % 5 == 4:
+                cats.append(leaves[(i + len(leaves) // 2) % len(leaves)])
+            self.book_cats[i] = cats
+
+    def is_free(self, i):
+        "Return if book number i is free (every fourth one is not)."
+
+        return i % 4 != 3
+
+    def pdf_urls(self, cat=None):
+        "Return the URLs of all free PDFs, or of those listed in a category."
+
+        return [self.url + self._pdf_path(i) for i in self._cat_books(cat)
+            if self.is_free(i)]
+
+    def book(self, url):
+        "Return the book number of some PDF URL, path or file name."
+
+        return int(re.search(r'book-(\d+)\.pdf$', url).group(1))
+
+    def _cat_books(self, cat=None):
+        return [i for i in range(self.books) if cat is None or any(
+            c == cat or c.startswith(cat + '/') for c in self.book_cats[i])]
+
+    def _pdf_path(self, i):
+        section = self.book_cats[i][0].split('/')[0]
+        return '/%s/free/files/book-%03d.pdf' % (section, i)
+
+    def pdf_body(self, i):
+        "Return the content of the PDF for book number i."
+
+        head = b'%PDF-1.4\n% book ' + str(i).encode() + b'\n'
+        tail = b'\n%%EOF\n'
+        filler = max(0, self.pdf_size - len(head) - len(tail))
+        return head + b'0' * filler + tail
+
+    # request handling
+
+    async def _respond(self, request, kind, body, content_type='text/html'):
+        """Send a body after some latency, honouring ranges and validators.
+
+        Beyond its capacity of requests at a time, the shop throttles (429).
+        """
+        if self.capacity and self.in_flight >= self.capacity:
+            self.hits['throttled'] += 1
+            return web.Response(status=429)
+        self.in_flight += 1
+        try:
+            return await self._send(request, kind, body, content_type)
+        finally:
+            self.in_flight -= 1
+
+    async def _send(self, request, kind, body, content_type):
+        self.hits[kind] += 1
+        self.log.append(kind)
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        etag = '"%s"' % hashlib.sha1(body).hexdigest()
+        headers = {'ETag': etag, 'Last-Modified': self.last_modified,
+            'Accept-Ranges': 'bytes', 'Content-Type': content_type}
+        # If-Modified-Since only counts without If-None-Match (RFC 7232).
+        if 'If-None-Match' in request.headers:
+            unchanged = request.headers['If-None-Match'] == etag
+        else:
+            unchanged = request.headers.get('If-Modified-Since') == \
+                self.last_modified
+        if unchanged:
+            return web.Response(status=304, headers=headers)
+        status, size = 200, len(body)
+        m = re.match(r'bytes=(\d+)-(\d*)$', request.headers.get('Range', ''))
+        # A range of another version of the body gets all of this one.
+        if request.headers.get('If-Range', etag) not in (etag,
+                self.last_modified):
+            m = None
+        if m:
+            start = int(m.group(1))
+            end = int(m.group(2)) if m.group(2) else size - 1
+            if start >= size:
+                headers['Content-Range'] = 'bytes */%d' % size
+                return web.Response(status=416, headers=headers)
+            end = min(end, size - 1)
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (start, end, size)
+            status, body = 206, body[start:end + 1]
+        headers['Content-Length'] = str(len(body))
+        response = web.StreamResponse(status=status, headers=headers)
+        await response.prepare(request)
+        try:
+            if request.method != 'HEAD':
+                chunk_size = 16 * 1024
+                for i in range(0, len(body), chunk_size):
+                    chunk = body[i:i + chunk_size]
+                    if self.bandwidth:
+                        await asyncio.sleep(len(chunk) / float(self.bandwidth))
+                    await response.write(chunk)
+                    self.bytes_sent += len(chunk)
+            await response.write_eof()
+        except ConnectionResetError:
+            # The client closed the connection before reading everything.
+            pass
+        return response
+
+    async def _top(self, request):
+        links = ''.join('<li><a href="/category/ebooks/%s.do">%s</a></li>' % (
+            cat, cat) for cat in sorted(self.cats))
+        html = '<html><body><ul>%s</ul></body></html>' % links
+        return await self._respond(request, 'top', html.encode())
+
+    async def _cat(self, request):
+        cat = request.match_info['cat']
+        top = cat.split('/')[0]
+        if top not in self.cats or cat != top and cat not in self.cats[top]:
+            raise web.HTTPNotFound()
+        links = ''.join('<li><a href="/category/ebooks/%s.do">%s</a></li>' % (
+            c, c) for c in [top] + self.cats[top])
+        books = self._cat_books(cat)
+        pages = max(1, (len(books) + self.per_page - 1) // self.per_page)
+        page = int(request.query.get('page', 1))
+        options = ''.join('<option value="/category/ebooks/%s.do?sortby='
+            'publicationDate&amp;page=%d">%d</option>' % (cat, p, p)
+            for p in range(1, pages + 1))
+        items = ''.join(self._item(i)
+            for i in books[(page - 1) * self.per_page:page * self.per_page])
+        html = '<html><body><ul>%s</ul>' \
+            '<table class="pagination"><tr><td class="default">' \
+            '<select name="dirPage">%s</select></td></tr></table>' \
+            '<table>%s</table></body></html>' % (links, options, items)
+        return await self._respond(request, 'cat', html.encode())
+
+    def _item(self, i):
+        price = '$0.00' if self.is_free(i) else '$9.99'
+        return '<tr><td class="thumbtext">' \
+            '<div class="thumbheader"><a href="/product/%013d.do">' \
+            'Book %d</a></div><div class="widthchange"><div class="price">' \
+            '<div><span class="price">%s</span></div></div></div>' \
+            '</td></tr>' % (i, i, price)
+
+    async def _product(self, request):
+        i = int(request.match_info['id'])
+        if i >= self.books:
+            raise web.HTTPNotFound()
+        path = self._pdf_path(i)[1:].replace('/files/', '/')[:-4] + '.csp'
+        html = '<html><head><script>var s = {\n' \
+            '  path_info: %s?intcmp=il-data-free-lp-lgen,\n' \
+            '};</script></head><body>%s</body></html>' % (
+            path, '<p>Lorem ipsum.</p>' * 5000)
+        return await self._respond(request, 'product', html.encode())
+
+    async def _pdf(self, request):
+        m = re.match(r'book-(\d+)$', request.match_info['name'])
+        if not m or int(m.group(1)) >= self.books:
+            raise web.HTTPNotFound()
+        body = self.pdf_body(int(m.group(1)))
+        return await self._respond(request, 'pdf', body, 'application/pdf')
+
+    def app(self):
+        "Return the aiohttp application serving the shop."
+
+        app = web.Application()
+        app.router.add_get('/category/ebooks.do', self._top)
+        app.router.add_get('/category/ebooks/{cat:.+}.do', self._cat)
+        app.router.add_get('/product/{id:\\d+}.do', self._product)
+        app.router.add_get('/{section}/free/files/{name}.pdf', self._pdf)
+        return app
+
+    # running
+
+    def start(self):
+        "Start serving in a background thread."
+
+        self._loop = asyncio.new_event_loop()
+        self._runner = web.AppRunner(self.app())
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, self.host, self.port)
+        self._loop.run_until_complete(site.start())
+        self.port = self._runner.addresses[0][1]
+        self._thread = threading.Thread(target=self._loop.run_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        "Stop serving and close the event loop."
+
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.run_until_complete(self._runner.cleanup())
+        self._loop.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+def main():
+    desc = 'Serve a local stand-in for the O\'Reilly online shop.'
+    p = argparse.ArgumentParser(description=desc)
+    p.add_argument('--port', metavar='N', type=int, default=8080,
+        help='Port to listen on (default: 8080).')
+    p.add_argument('--books', metavar='N', type=int, default=30,
+        help='Number of books in the shop (default: 30).')
+    p.add_argument('--pdf-size', metavar='BYTES', type=int,
+        default=100 * 1024, help='Size of each PDF (default: 102400).')
+    p.add_argument('--latency', metavar='SECONDS', type=float, default=0.0,
+        help='Delay before each response (default: 0).')
+    p.add_argument('--bandwidth', metavar='BYTES', type=int,
+        help='Bytes per second sent per response (default: unlimited).')
+    p.add_argument('--capacity', metavar='N', type=int,
+        help='Requests served at a time, throttling more with HTTP 429 '
+             '(default: unlimited).')
+    args = p.parse_args()
+
+    shop = MockShop(books=args.books, pdf_size=args.pdf_size,
+        latency=args.latency, bandwidth=args.bandwidth,
+        capacity=args.capacity, port=args.port)
+    web.run_app(shop.app(), host=shop.host, port=shop.port)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+"""
+Retry policies for failing HTTP requests.
+"""
+
+import time
+import random
+import asyncio
+
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class TransientError(IOError):
+    "An error that is worth retrying the request for."
+
+
+class RetryPolicy(object):
+    "Retry requests with exponential backoff and jitter, up to some limit."
+
+    def __init__(self, max_attempts=5, backoff=0.5, max_backoff=30.0,
+        retry_statuses=RETRY_STATUSES):
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.retry_statuses = set(retry_statuses)
+
+    def check(self, url, status):
+        "Raise a TransientError if a response status should be retried."
+
+        if status in self.retry_statuses:
+            raise TransientError('HTTP status %d for %s' % (status, url))
+
+    def delay(self, attempt):
+        "Return the seconds to wait after some failed attempt (from 1)."
+
+        # "Full jitter", which spreads retries of parallel requests best.
+        cap = min(self.max_backoff, self.backoff * 2 ** (attempt - 1))
+        return random.uniform(0, cap)
+
+    def _failed(self, attempt, url, exc, verbose):
+        "Return the delay before the next attempt, or re-raise if none."
+
+        if attempt >= self.max_attempts:
+            raise exc
+        delay = self.delay(attempt)
+        if verbose:
+            print('retrying %s in %.1fs (%s)...' % (url, delay, exc or
+                type(exc).__name__))
+        return delay
+
+    def call(self, func, errors, url='', verbose=False):
+        "Call func until it does not raise any of the given errors."
+
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return func()
+            except errors as exc:
+                time.sleep(self._failed(attempt, url, exc, verbose))
+
+    async def call_async(self, func, errors, url='', verbose=False):
+        "Await func() until it does not raise any of the given errors."
+
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                return await func()
+            except errors as exc:
+                await asyncio.sleep(self._failed(attempt, url, exc, verbose))
@@ -0,0 +1,63 @@
+"""
+A persistent record of crawled product pages, for incremental crawls.
+
+Maps the path of each product page to the PDF URL it was resolved to (or
+None if it has none) and records when it was resolved and last seen in a
+category listing, so later crawls only need to fetch product pages not
+seen before, or resolved longer ago than some time to live.
+"""
+
+import time
+import sqlite3
+import threading
+
+
+TTL = 30 * 24 * 3600
+
+
+class CrawlState(object):
+    "An SQLite store of product paths with their resolved PDF URLs."
+
+    def __init__(self, path, ttl=TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # Shards in other processes may use the same state file.
+        self._db = sqlite3.connect(path, timeout=60,
+            check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS products ('
+            'path TEXT PRIMARY KEY, pdf_url TEXT, resolved REAL, '
+            'last_seen REAL)')
+        self._db.commit()
+
+    def get(self, path):
+        """Return if a product path is known, and its PDF URL if so.
+
+        A product resolved longer ago than the time to live is unknown.
+        Otherwise it is marked as seen now.
+        """
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT pdf_url, resolved FROM products '
+                'WHERE path = ?', (path,)).fetchone()
+            if row is None or self.ttl and now - row[1] > self.ttl:
+                return False, None
+            self._db.execute('UPDATE products SET last_seen = ? '
+                'WHERE path = ?', (now, path))
+            # Release the write lock right away, for other processes.
+            self._db.commit()
+        return True, row[0]
+
+    def put(self, path, pdf_url):
+        "Record the PDF URL some product path was resolved to just now."
+
+        now = time.time()
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO products VALUES '
+                '(?, ?, ?, ?)', (path, pdf_url, now, now))
+            self._db.commit()
+
+    def close(self):
+        with self._lock:
+            self._db.commit()
+            self._db.close()
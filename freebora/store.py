@@ -0,0 +1,126 @@
+"""
+A content-addressed store of downloaded files, shared by destinations.
+
+Files are stored once under their SHA-256, as ``<store>/ab/cdef...``, and
+linked into each destination folder, with hardlinks if possible, else as
+copies. An index maps each downloaded URL to the hash of its content, so
+a URL downloaded into any destination before needs no fetching again.
+Files linked into a destination share their content with the store, so
+they should not be modified in place.
+"""
+
+import os
+import time
+import errno
+import shutil
+import sqlite3
+import tempfile
+import threading
+
+
+# Errors of hardlinks not possible here, so files are copied instead.
+NO_LINK_ERRORS = (errno.EXDEV, errno.EPERM, errno.EMLINK)
+
+
+def _link_or_copy(src, folder, suffix):
+    """Hardlink or copy a file to a new temporary file in some folder.
+
+    The temporary file has a name of its own, so other processes or threads
+    doing the same never write to it. Return its path.
+    """
+    fd, tmp = tempfile.mkstemp(suffix=suffix, dir=folder)
+    os.close(fd)
+    os.remove(tmp)
+    try:
+        os.link(src, tmp)
+    except OSError as exc:
+        if exc.errno not in NO_LINK_ERRORS:
+            raise
+        shutil.copyfile(src, tmp)
+    return tmp
+
+
+class Store(object):
+    "A folder of files named by their SHA-256, with an index of URLs."
+
+    def __init__(self, path):
+        self.path = path
+        if not os.path.exists(path):
+            os.makedirs(path, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(path, 'index.db'),
+            timeout=60, check_same_thread=False)
+        self._db.execute('CREATE TABLE IF NOT EXISTS urls ('
+            'url TEXT PRIMARY KEY, sha256 TEXT, size INTEGER, etag TEXT, '
+            'last_modified TEXT)')
+        self._db.commit()
+
+    def object_path(self, sha256):
+        "Return the path of the stored file with some SHA-256."
+
+        return os.path.join(self.path, sha256[:2], sha256[2:])
+
+    def get(self, url):
+        """Return SHA-256, size, ETag and Last-Modified of a stored URL.
+
+        Return None if the URL is unknown or its file is not stored.
+        """
+        with self._lock:
+            row = self._db.execute('SELECT sha256, size, etag, '
+                'last_modified FROM urls WHERE url = ?', (url,)).fetchone()
+        if row is None or not os.path.exists(self.object_path(row[0])):
+            return None
+        return row
+
+    def link(self, sha256, path):
+        "Link the stored file with some SHA-256 to some path, atomically."
+
+        tmp = _link_or_copy(self.object_path(sha256),
+            os.path.dirname(path) or '.', '.link')
+        os.replace(tmp, path)
+
+    def add(self, entry, path):
+        """Store the file of some manifest entry, and index its URL.
+
+        If the content is stored already, the file is replaced with a link
+        to it, so it takes disk space only once.
+        """
+        obj = self.object_path(entry.sha256)
+        if os.path.exists(obj):
+            self.link(entry.sha256, path)
+        else:
+            if not os.path.exists(os.path.dirname(obj)):
+                os.makedirs(os.path.dirname(obj), exist_ok=True)
+            # Others adding the same content at the same time store the
+            # same bytes, so whoever replaces last does no harm.
+            tmp = _link_or_copy(path, os.path.dirname(obj), '.tmp')
+            os.replace(tmp, obj)
+        with self._lock:
+            self._db.execute('INSERT OR REPLACE INTO urls VALUES '
+                '(?, ?, ?, ?, ?)', (entry.url, entry.sha256, entry.size,
+                entry.etag, entry.last_modified))
+            self._db.commit()
+
+    def sweep(self, age, verbose=False):
+        "Remove temporary files not written to for some age in seconds."
+
+        for folder in os.listdir(self.path):
+            folder = os.path.join(self.path, folder)
+            if not os.path.isdir(folder):
+                continue
+            for name in os.listdir(folder):
+                if not name.endswith('.tmp'):
+                    continue
+                path = os.path.join(folder, name)
+                try:
+                    if time.time() - os.stat(path).st_mtime < age:
+                        continue
+                    os.remove(path)
+                except FileNotFoundError:
+                    continue
+                if verbose:
+                    print('removed stale %s' % path)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -42,6 +42,7 @@ setup(
     },
     zip_safe=False,
     platforms='any',
+    python_requires='>=3.7',
     install_requires=get_dependencies('requirements.txt'),
     tests_require=['pytest'],
     cmdclass = {'test': PyTest},
@@ -50,7 +51,12 @@ setup(
         'Environment :: Console',
         'Programming Language :: Python',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.5',
+        'Programming Language :: Python :: 3 :: Only',
+        'Programming Language :: Python :: 3.7',
+        'Programming Language :: Python :: 3.8',
+        'Programming Language :: Python :: 3.9',
+        'Programming Language :: Python :: 3.10',
+        'Programming Language :: Python :: 3.11',
         'Intended Audience :: Education',
         'Intended Audience :: End Users/Desktop',
         'Intended Audience :: Information Technology',
@@ -0,0 +1,544 @@
+import os
+import time
+import hashlib
+import contextlib
+
+import pytest
+
+from freebora import freebora
+from freebora.mockshop import MockShop
+from freebora.cache import PageCache
+from freebora.state import CrawlState
+from freebora.retry import RetryPolicy
+from freebora.limits import RateLimits
+from freebora.manifest import Manifest
+from freebora.store import Store
+
+
+@pytest.fixture(scope='module')
+def shop():
+    "Point freebora at a local mock shop for the tests in this module."
+
+    with MockShop(books=40, pdf_size=50000) as shop, \
+            pytest.MonkeyPatch.context() as mp:
+        mp.setattr(freebora, 'SHOP_URL', shop.url)
+        mp.setattr(freebora, 'PDF_URL', shop.url)
+        yield shop
+
+
+@pytest.fixture
+def make_shop(monkeypatch):
+    "Return a function starting a mock shop to point freebora at instead."
+
+    with contextlib.ExitStack() as stack:
+
+        def make(**kwargs):
+            shop = stack.enter_context(MockShop(**kwargs))
+            monkeypatch.setattr(freebora, 'SHOP_URL', shop.url)
+            monkeypatch.setattr(freebora, 'PDF_URL', shop.url)
+            return shop
+
+        yield make
+
+
+def test_get_cats(shop):
+    "Test listing categories sequentially and in parallel."
+
+    cats = list(freebora.get_cats_sync())
+    assert 'data' in cats
+    assert 'programming/python' in cats
+    assert sorted(freebora.get_cats_async()) == sorted(cats)
+
+
+def test_plain_paths(shop):
+    "Test that paths extracted from pages do not keep their page alive."
+
+    html = freebora.requests.get(shop.url + '/category/ebooks.do').content
+    paths = freebora._cat_paths(html)
+    assert paths and all(type(p) is str for p in paths)
+
+
+def test_download_filelist(shop):
+    "Test collecting PDF URLs sequentially and in parallel."
+
+    expected = sorted(shop.pdf_urls('data'))
+    assert sorted(freebora.download_filelist_sync('data')) == expected
+    assert sorted(freebora.download_filelist_async('data')) == expected
+
+
+@pytest.mark.parametrize('download', [
+    freebora.download_files_sync,
+    freebora.download_files_async,
+    freebora.download_files_threaded,
+])
+def test_download_files(shop, tmpdir, download):
+    "Test downloading PDFs sequentially and in parallel."
+
+    urls = shop.pdf_urls('design')
+    assert download(urls, dest=str(tmpdir)) == []
+    for url in urls:
+        path = os.path.join(str(tmpdir), os.path.basename(url))
+        i = shop.book(url)
+        assert open(path, 'rb').read() == shop.pdf_body(i)
+
+
+def test_resume_download(shop, tmpdir):
+    "Test resuming a download from a partial file."
+
+    url = shop.pdf_urls('data')[0]
+    body = shop.pdf_body(0)
+    path = os.path.join(str(tmpdir), os.path.basename(url))
+    with open(path + '.part', 'wb') as f:
+        f.write(body[:1000])
+    with open(path + '.part.validator', 'w') as f:
+        f.write('"%s"' % hashlib.sha1(body).hexdigest())
+    sent = shop.bytes_sent
+    assert freebora.download_files_sync([url], dest=str(tmpdir)) == []
+    assert open(path, 'rb').read() == body
+    assert shop.bytes_sent - sent == len(body) - 1000
+    assert not os.path.exists(path + '.part')
+    assert not os.path.exists(path + '.part.validator')
+
+
+@pytest.mark.parametrize('download', [
+    freebora.download_files_sync,
+    freebora.download_files_async,
+])
+@pytest.mark.parametrize('validator,overwrite', [
+    ('"old"', False),
+    (None, False),
+    (None, True),
+])
+def test_resume_changed(shop, tmpdir, download, validator, overwrite):
+    "Test that partial downloads of other versions are not resumed."
+
+    url = shop.pdf_urls('data')[0]
+    body = shop.pdf_body(0)
+    path = os.path.join(str(tmpdir), os.path.basename(url))
+    with open(path + '.part', 'wb') as f:
+        f.write(b'%PDF-1.3\n' + b'x' * 10000)
+    if validator:
+        with open(path + '.part.validator', 'w') as f:
+            f.write(validator)
+    sent = shop.bytes_sent
+    assert download([url], dest=str(tmpdir), overwrite=overwrite) == []
+    assert open(path, 'rb').read() == body
+    assert shop.bytes_sent - sent == len(body)
+    assert os.listdir(str(tmpdir)) == [os.path.basename(url)]
+
+
+def test_page_cache(shop, tmpdir):
+    "Test that a repeated crawl revalidates pages from the cache."
+
+    cache = PageCache(str(tmpdir.join('cache.db')))
+    expected = sorted(shop.pdf_urls('data'))
+    assert sorted(freebora.download_filelist_sync('data', cache=cache)) \
+        == expected
+    sent = shop.bytes_sent
+    assert sorted(freebora.download_filelist_async('data', cache=cache)) \
+        == expected
+    assert shop.bytes_sent == sent
+
+
+def test_incremental_crawl(shop, tmpdir):
+    "Test that a repeated incremental crawl skips known product pages."
+
+    state = CrawlState(str(tmpdir.join('state.db')))
+    expected = sorted(shop.pdf_urls('design'))
+    assert sorted(freebora.download_filelist_sync('design', state=state)) \
+        == expected
+    hits = shop.hits['product']
+    assert sorted(freebora.download_filelist_async('design', state=state)) \
+        == expected
+    assert shop.hits['product'] == hits
+    # Marking products as seen holds no lock on the file.
+    other = CrawlState(str(tmpdir.join('state.db')))
+    other.put('/product/0.do', None)
+    other.close()
+    state.close()
+
+
+def test_crawl_cats(shop):
+    "Test crawling several categories, with shared products fetched once."
+
+    cats = freebora.match_cats(['data', 'data/*'], freebora.get_cats_sync())
+    assert cats == ['data', 'data/big-data', 'data/data-science']
+    expected = sorted(shop.pdf_urls('data'))
+    for lister in freebora.download_filelist_sync, \
+            freebora.download_filelist_async:
+        hits = shop.hits['product']
+        assert sorted(lister(cats)) == expected
+        assert shop.hits['product'] - hits == len(expected)
+
+
+def test_missing_cat(shop):
+    "Test that a category page not found is failed, not taken as empty."
+
+    for lister in freebora.download_filelist_sync, \
+            freebora.download_filelist_async:
+        failed = []
+        assert list(lister('nosuchcat', failed=failed)) == []
+        assert failed == [freebora.SHOP_URL + '/category/ebooks/nosuchcat.do']
+
+
+def test_resolve_early(make_shop):
+    "Test that product pages are read only up to their PDF path."
+
+    shop = make_shop(books=8, bandwidth=2000000)
+    expected = sorted(shop.pdf_urls('data'))
+    for lister in freebora.download_filelist_sync, \
+            freebora.download_filelist_async:
+        sent = shop.bytes_sent
+        assert sorted(lister('data')) == expected
+        assert shop.bytes_sent - sent < 50000 * len(expected)
+
+
+def test_parse_processes(shop):
+    "Test parsing crawled pages in a pool of processes."
+
+    expected = sorted(shop.pdf_urls('data'))
+    assert sorted(freebora.download_filelist_async('data',
+        parse_processes=2)) == expected
+
+
+def test_parse_threads(shop, monkeypatch):
+    "Test parsing crawled pages in a pool of threads of the size given."
+
+    sizes = []
+
+    class Executor(freebora.concurrent.futures.ThreadPoolExecutor):
+        def __init__(self, max_workers=None, **kwargs):
+            sizes.append(max_workers)
+            super().__init__(max_workers, **kwargs)
+
+    monkeypatch.setattr(freebora.concurrent.futures, 'ThreadPoolExecutor',
+        Executor)
+    cats = list(freebora.get_cats_async(executor_size=3))
+    assert sorted(freebora.download_filelist_async('data',
+        executor_size=2)) == sorted(shop.pdf_urls('data'))
+    assert 'data' in cats and sizes == [3, 2]
+
+
+def test_adaptive_concurrency(make_shop, tmpdir):
+    "Test adapting the concurrency to a shop throttling requests."
+
+    shop = make_shop(books=40, pdf_size=50000, latency=0.01, capacity=4)
+    urls = shop.pdf_urls()
+    retry = RetryPolicy(max_attempts=10, backoff=0.01)
+    assert freebora.download_files_async(urls, dest=str(tmpdir),
+        concurrency=2, adaptive=True, retry=retry) == []
+    assert shop.hits['pdf'] == len(urls)
+    assert shop.hits['throttled'] < len(urls) // 2
+
+
+def test_rate_limits(shop, tmpdir):
+    "Test capping the requests per second, beyond an initial burst."
+
+    urls = shop.pdf_urls('data')
+    t0 = time.time()
+    assert freebora.download_files_async(urls, dest=str(tmpdir),
+        rates=RateLimits(max_rps=10)) == []
+    assert time.time() - t0 >= (len(urls) - 10) / 10.0 - 0.05
+
+
+def test_segmented_download(shop, tmpdir):
+    "Test downloading PDFs in parallel segments."
+
+    urls = shop.pdf_urls('design')
+    hits = shop.hits['pdf']
+    assert freebora.download_files_async(urls, dest=str(tmpdir), segments=3,
+        segment_threshold=10000) == []
+    assert shop.hits['pdf'] - hits == 4 * len(urls)
+    for url in urls:
+        path = os.path.join(str(tmpdir), os.path.basename(url))
+        i = shop.book(url)
+        assert open(path, 'rb').read() == shop.pdf_body(i)
+    assert sorted(os.listdir(str(tmpdir))) == sorted(
+        os.path.basename(url) for url in urls)
+
+
+def test_sweep(shop, tmpdir):
+    "Test removing stale temporary files, but keeping resumable ones."
+
+    url = shop.pdf_urls('design')[0]
+    name = os.path.basename(url)
+    body = shop.pdf_body(shop.book(name))
+    tmpdir.join('a.pdf.segments').write('x')
+    tmpdir.join('b.pdf.part').write('')
+    tmpdir.join('c.pdf').write('x')
+    tmpdir.join('c.pdf.part').write('x')
+    tmpdir.join(name + '.part').write_binary(body[:10])
+    tmpdir.join(name + '.part.validator').write(
+        '"%s"' % hashlib.sha1(body).hexdigest())
+    old = time.time() - freebora.STALE_AGE - 1
+    for path in tmpdir.listdir():
+        os.utime(str(path), (old, old))
+    # Files written to just now may belong to another process.
+    tmpdir.join('d.pdf.segments').write('x')
+    tmpdir.join('e.pdf.part').write('')
+    assert freebora.download_files_async([url], dest=str(tmpdir)) == []
+    assert tmpdir.join(name).read_binary() == body
+    assert sorted(os.listdir(str(tmpdir))) == sorted(['c.pdf', name,
+        'd.pdf.segments', 'e.pdf.part'])
+
+
+@pytest.mark.parametrize('download', [
+    freebora.download_files_sync,
+    freebora.download_files_async,
+])
+def test_manifest(shop, tmpdir, download):
+    "Test recording downloads in a manifest, and skipping recorded ones."
+
+    urls = shop.pdf_urls('design')
+    manifest = Manifest(str(tmpdir.join('manifest.db')))
+    assert download(urls[1:], dest=str(tmpdir), manifest=manifest) == []
+    manifest.close()
+    manifest = Manifest(str(tmpdir.join('manifest.db')))
+    assert len(manifest) == len(urls) - 1
+    for url in urls[1:]:
+        entry = manifest.get(url)
+        body = shop.pdf_body(shop.book(entry.filename))
+        assert entry.filename == os.path.basename(url)
+        assert entry.size == len(body)
+        assert entry.sha256 == hashlib.sha256(body).hexdigest()
+        assert entry.etag
+        assert entry.verified
+    hits = shop.hits['pdf']
+    assert download(urls, dest=str(tmpdir), manifest=manifest) == []
+    assert shop.hits['pdf'] - hits == 1
+    assert len(manifest) == len(urls)
+
+
+def test_store(shop, tmpdir):
+    "Test linking files downloaded into one destination into another one."
+
+    store = Store(str(tmpdir.join('store')))
+    urls = shop.pdf_urls('design')
+    a, b = tmpdir.mkdir('a'), tmpdir.mkdir('b')
+    assert freebora.download_files_sync(urls, dest=str(a), store=store) == []
+    hits = shop.hits['pdf']
+    assert freebora.download_files_async(urls, dest=str(b), store=store) == []
+    assert shop.hits['pdf'] == hits
+    for url in urls:
+        name = os.path.basename(url)
+        assert b.join(name).read_binary() == a.join(name).read_binary()
+        assert os.path.samefile(str(a.join(name)), str(b.join(name)))
+
+
+@pytest.mark.parametrize('download', [
+    freebora.download_files_sync,
+    freebora.download_files_async,
+])
+def test_refresh(make_shop, tmpdir, download):
+    "Test refreshing downloads with conditional requests."
+
+    shop = make_shop(books=10, pdf_size=20000)
+    urls = shop.pdf_urls()
+    manifest = Manifest(str(tmpdir.join('manifest.db')))
+    assert download(urls, dest=str(tmpdir), manifest=manifest) == []
+    hits, sent = shop.hits['pdf'], shop.bytes_sent
+    assert download(urls, dest=str(tmpdir), manifest=manifest,
+        refresh=True) == []
+    assert shop.hits['pdf'] - hits == len(urls)
+    assert shop.bytes_sent == sent
+    shop.pdf_size = 30000
+    assert download(urls, dest=str(tmpdir), manifest=manifest,
+        refresh=True) == []
+    for url in urls:
+        name = os.path.basename(url)
+        body = shop.pdf_body(shop.book(name))
+        assert tmpdir.join(name).read_binary() == body
+        assert manifest.get(url).sha256 == hashlib.sha256(body).hexdigest()
+    # Files gone are fetched again when refreshing, but only then.
+    tmpdir.join(os.path.basename(urls[0])).remove()
+    assert download(urls, dest=str(tmpdir), manifest=manifest) == []
+    assert not tmpdir.join(os.path.basename(urls[0])).exists()
+    hits = shop.hits['pdf']
+    assert download(urls, dest=str(tmpdir), manifest=manifest,
+        refresh=True) == []
+    assert tmpdir.join(os.path.basename(urls[0])).exists()
+    assert shop.hits['pdf'] - hits == len(urls)
+    manifest.close()
+
+
+@pytest.mark.parametrize('download', [
+    freebora.download_files_sync,
+    freebora.download_files_async,
+])
+def test_verify(make_shop, monkeypatch, tmpdir, download):
+    "Test rejecting files without PDF header, and retrying cut off ones."
+
+    shop = make_shop(books=10, pdf_size=20000)
+    urls = shop.pdf_urls()[:2]
+    body = shop.pdf_body
+    bodies = [b'<html></html>', body(1)[:-7]]
+    monkeypatch.setattr(shop, 'pdf_body', lambda i: bodies[i])
+    retry = RetryPolicy(max_attempts=3, backoff=0.01)
+    assert download(urls, dest=str(tmpdir), retry=retry) == urls
+    assert shop.hits['pdf'] == 1 + 3
+    assert os.listdir(str(tmpdir)) == []
+    bodies[1] = body(1)
+    assert download(urls[1:], dest=str(tmpdir), retry=retry) == []
+    assert tmpdir.join(os.path.basename(urls[1])).read_binary() == body(1)
+
+
+def test_threaded_download(shop, tmpdir):
+    "Test downloading PDFs in threads sharing a manifest and store."
+
+    urls = shop.pdf_urls()
+    manifest = Manifest(str(tmpdir.join('manifest.db')))
+    store = Store(str(tmpdir.join('store')))
+    assert freebora.download_files_threaded(urls, dest=str(tmpdir),
+        workers=4, manifest=manifest, store=store) == []
+    assert len(manifest) == len(urls)
+    for url in urls:
+        name = os.path.basename(url)
+        body = shop.pdf_body(shop.book(name))
+        assert tmpdir.join(name).read_binary() == body
+        assert store.get(url)[0] == hashlib.sha256(body).hexdigest()
+    manifest.close()
+    store.close()
+
+
+def test_in_shard():
+    "Test that shards split keys evenly, and that more shards move few."
+
+    keys = ['http://x/book-%03d.pdf' % i for i in range(300)]
+    three = [[k for k in keys if freebora.in_shard(k, i, 3)]
+        for i in range(3)]
+    assert sorted(sum(three, [])) == keys
+    assert all(70 < len(shard) < 130 for shard in three)
+    four = [[k for k in keys if freebora.in_shard(k, i, 4)]
+        for i in range(4)]
+    for i in range(3):
+        assert set(four[i]) <= set(three[i])
+
+
+def test_sharded_crawl(shop):
+    "Test that crawls of all shards cover all products once."
+
+    expected = sorted(shop.pdf_urls('data'))
+    for lister in freebora.download_filelist_sync, \
+            freebora.download_filelist_async:
+        hits = shop.hits['product']
+        urls = []
+        for i in range(3):
+            urls += lister('data', shard=(i, 3))
+        assert sorted(urls) == expected
+        assert shop.hits['product'] - hits == len(expected)
+
+
+def test_store_concurrent(tmpdir):
+    "Test adding the same content to a store from many threads at once."
+
+    store = Store(str(tmpdir.join('store')))
+    body = b'%PDF-1.4\n' + b'0' * 100000 + b'\n%%EOF\n'
+    sha256 = hashlib.sha256(body).hexdigest()
+    entries = []
+    for i in range(8):
+        dest = tmpdir.mkdir('dest%d' % i)
+        dest.join('a.pdf').write_binary(body)
+        entries.append((freebora.Entry('http://x/%d/a.pdf' % i, 'a.pdf',
+            len(body), None, None, sha256, time.time(), True),
+            str(dest.join('a.pdf'))))
+    with freebora.concurrent.futures.ThreadPoolExecutor(8) as executor:
+        list(executor.map(lambda args: store.add(*args), entries))
+    for entry, path in entries:
+        assert open(path, 'rb').read() == body
+        assert store.get(entry.url)[0] == sha256
+    folder = os.path.dirname(store.object_path(sha256))
+    assert os.listdir(folder) == [sha256[2:]]
+    stale = os.path.join(folder, 'x.tmp')
+    open(stale, 'w').close()
+    store.sweep(age=0)
+    assert not os.path.exists(stale)
+    store.close()
+
+
+def test_download_cat(make_shop, monkeypatch, tmpdir):
+    "Test crawling and downloading in one run, with downloads overlapping."
+
+    shop = make_shop(books=40, pdf_size=20000, latency=0.01)
+    urls = shop.pdf_urls('data')
+    bad = urls[0]
+    body = shop.pdf_body
+    bad_book = shop.book(bad)
+    monkeypatch.setattr(shop, 'pdf_body',
+        lambda i: b'<html></html>' if i == bad_book else body(i))
+    failed = []
+    assert freebora.download_cat_async('data', dest=str(tmpdir),
+        concurrency=2, queue_size=1, failed=failed) == [bad]
+    assert failed == []
+    assert sorted(os.listdir(str(tmpdir))) == sorted(
+        os.path.basename(url) for url in urls[1:])
+    products = [i for i, kind in enumerate(shop.log) if kind == 'product']
+    assert shop.log.index('pdf') < products[-1]
+
+
+def test_timeouts(make_shop, tmpdir):
+    "Test that timeouts given replace only the same ones of the session."
+
+    shop = make_shop(books=4, pdf_size=20000, latency=0.5)
+    urls = shop.pdf_urls()
+    retry = RetryPolicy(max_attempts=1)
+    assert freebora.download_files_async(urls, dest=str(tmpdir),
+        timeout=0.1, retry=retry) == urls
+
+    async def fetch():
+        timeouts = freebora.Timeouts(0.1, None, None)
+        async with freebora._client_session(timeouts) as session:
+            await freebora.fetch(session, urls[0], dest=str(tmpdir),
+                connect_timeout=5)
+
+    with pytest.raises(freebora.asyncio.TimeoutError):
+        freebora.asyncio.run(fetch())
+
+
+@pytest.mark.parametrize('download', [
+    freebora.download_files_sync,
+    freebora.download_files_async,
+])
+def test_manifest_adopt(shop, tmpdir, download):
+    "Test recording files found without manifest, and replacing cut ones."
+
+    urls = shop.pdf_urls('design')[:2]
+    names = [os.path.basename(url) for url in urls]
+    bodies = [shop.pdf_body(shop.book(name)) for name in names]
+    tmpdir.join(names[0]).write_binary(bodies[0])
+    tmpdir.join(names[1]).write_binary(bodies[1][:1000])
+    manifest = Manifest(str(tmpdir.join('manifest.db')))
+    hits = shop.hits['pdf']
+    assert download(urls, dest=str(tmpdir), manifest=manifest) == []
+    assert shop.hits['pdf'] - hits == 1
+    assert tmpdir.join(names[1]).read_binary() == bodies[1]
+    entry = manifest.get(urls[0])
+    assert entry.sha256 == hashlib.sha256(bodies[0]).hexdigest()
+    assert entry.verified is None
+    assert manifest.get(urls[1]).verified
+    manifest.close()
+
+
+def test_segments_limited(make_shop, tmpdir):
+    "Test that segments count against the limit of requests in flight."
+
+    shop = make_shop(books=10, pdf_size=50000, latency=0.01, capacity=3)
+    urls = shop.pdf_urls()
+    assert freebora.download_files_async(urls, dest=str(tmpdir),
+        concurrency=2, segments=4, segment_threshold=10000,
+        retry=RetryPolicy(max_attempts=5, backoff=0.01)) == []
+    assert shop.hits['throttled'] == 0
+    assert shop.hits['pdf'] == 5 * len(urls)
+
+
+def test_segments_changed(make_shop, monkeypatch, tmpdir):
+    "Test that a file changing between segments is fetched again."
+
+    shop = make_shop(books=1, pdf_size=50000)
+    url = shop.pdf_urls()[0]
+    body = shop.pdf_body
+    new = body(0).replace(b'% book', b'% BOOK')
+    monkeypatch.setattr(shop, 'pdf_body',
+        lambda i: body(i) if shop.hits['pdf'] <= 1 else new)
+    assert freebora.download_files_async([url], dest=str(tmpdir),
+        segments=3, segment_threshold=10000) == []
+    assert tmpdir.join(os.path.basename(url)).read_binary() == new